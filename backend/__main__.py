@@ -10,7 +10,7 @@ from pydantic import BaseModel
 from typing import Any
 
 from .endpoints import ws_handlers
-from .lib import database
+from .lib import assets, database, fog, movement, temporary
 from .lib.errors import AuthError, JsonError
 from .lib.security import check_password
 from .lib.utils import require
@@ -32,6 +32,21 @@ from .endpoints.folders import router as folder_router
 app = FastAPI()
 
 
+@app.on_event("startup")
+async def startup():
+    database.initialize()
+    assets.ensure_asset_index()
+    temporary.start_reaping()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    temporary.stop_reaping()
+    await fog.flush_all()
+    movement.write_all()
+    database.flush_write_behind()
+
+
 @app.exception_handler(AuthError)
 async def auth_error_handler(request: Request, exc: AuthError):
     return JSONResponse(status_code=401, content={
@@ -110,7 +125,9 @@ async def handle_ws_request(connection: Connection, request: dict[str, Any]):
     if message_type == "heartbeat":
         return
 
-    print("/api/live - Request -", request)
+    # Token moves come in many times a second while dragging
+    if message_type != "move-token":
+        print("/api/live - Request -", request)
 
     if message_type == "subscribe":
         pool = get_pool(request)
@@ -1,7 +1,7 @@
 from fastapi import APIRouter
 from typing import Optional
 
-from ..lib import database
+from ..lib import database, listings
 from ..lib.errors import JsonError
 from ..lib.utils import require, auth_require
 from ..models.database_models import Ability, Permissions, get_pool
@@ -26,12 +26,15 @@ async def ability_create(request: AbilityCreateRequest):
         ability.add_permission("*", "*", Permissions.READ)
         ability.add_permission(request.requester.id, "*", Permissions.OWNER)
 
+    ability.ancestors = []
     if ability.folder_id is not None:
         folder = require(database.ability_folders.find_one(ability.folder_id), "invalid folder id")
         if not request.requester.is_gm:
             auth_require(folder.has_permission(request.requester.id, "*", Permissions.WRITE))
+        ability.ancestors = folder.lineage
 
     ability = database.abilities.create(ability.model_dump(exclude_defaults=True))
+    listings.invalidate_listing("ability", ability.folder_id)
 
     await get_pool("abilities").broadcast({
         "type": "create",
@@ -52,6 +55,7 @@ async def ability_delete(request: AbilityDeleteRequest):
     if not request.requester.is_gm:
         auth_require(ability.has_permission(request.requester.id, "*", Permissions.OWNER))
     database.abilities.delete_one(ability.id)
+    listings.invalidate_listing("ability", ability.folder_id)
     await ability.pool.broadcast({
         "type": "delete",
     })
@@ -75,6 +79,7 @@ async def ability_update(request: AbilityUpdateRequest):
         auth_require(ability.has_permission(request.requester.id, "*", Permissions.WRITE))
 
     database.abilities.find_one_and_update(request.id, request.changes)
+    listings.invalidate_listing("ability", ability.folder_id)
 
     await ability.broadcast_changes(request.changes)
 
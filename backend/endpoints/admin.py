@@ -1,6 +1,7 @@
 from fastapi import APIRouter
 
-from ..lib import database
+from ..lib import database, fog, temporary
+from ..lib.assets import rebuild_asset_index
 from ..lib.errors import JsonError
 from ..lib.security import hash_password
 from ..models.database_models import User
@@ -26,3 +27,23 @@ async def admin_create_request(request: CreateAdminRequest):
 @router.post("/list-users")
 async def admin_create_request(request: AdminConsoleRequest):
     return {"status": "success", "users": [user.name for user in database.users.find()]}
+
+
+@router.post("/rebuild-asset-index")
+async def admin_rebuild_asset_index(request: AdminConsoleRequest):
+    return {"status": "success", "references": rebuild_asset_index()}
+
+
+@router.post("/fog-metrics")
+async def admin_fog_metrics(request: AdminConsoleRequest):
+    return {"status": "success", "maps": fog.get_metrics()}
+
+
+@router.post("/write-behind-metrics")
+async def admin_write_behind_metrics(request: AdminConsoleRequest):
+    return {"status": "success", "collections": database.get_write_behind_metrics()}
+
+
+@router.post("/reap-temporary")
+async def admin_reap_temporary(request: AdminConsoleRequest):
+    return {"status": "success", "characters": temporary.reap_orphaned_characters()}
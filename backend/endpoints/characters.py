@@ -1,7 +1,7 @@
 from fastapi import APIRouter
 from typing import Optional
 
-from ..lib import database
+from ..lib import database, listings
 from ..lib.errors import JsonError
 from ..lib.utils import require, auth_require
 from ..models.database_models import Alignment, Character, Permissions, get_pool
@@ -26,12 +26,15 @@ async def character_create(request: CharacterCreateRequest):
         character.add_permission(request.requester.id, "*", Permissions.OWNER)
         character.alignment = Alignment.PLAYER
 
+    character.ancestors = []
     if character.folder_id is not None:
         folder = require(database.character_folders.find_one(character.folder_id), "invalid folder id")
         if not request.requester.is_gm:
             auth_require(folder.has_permission(request.requester.id, "*", Permissions.WRITE))
+        character.ancestors = folder.lineage
 
     character = database.characters.create(character.model_dump(exclude_defaults=True))
+    listings.invalidate_listing("character", character.folder_id)
 
     if request.requester.character_id is None:
         user = database.users.find_one_and_update(request.requester.id, {"$set": {"character_id": character.id}})
@@ -59,6 +62,7 @@ async def character_delete(request: CharacterDeleteRequest):
     if not request.requester.is_gm:
         auth_require(character.has_permission(request.requester.id, "*", Permissions.OWNER))
     database.characters.delete_one(character.id)
+    listings.invalidate_listing("character", character.folder_id)
     database.users.update_many({"character_id": character.id}, {"$set": {"character_id": None}})
     await character.pool.broadcast({
         "type": "delete",
@@ -82,7 +86,9 @@ async def character_update(request: CharacterUpdateRequest):
     if not request.requester.is_gm:
         auth_require(character.has_permission(request.requester.id, "*", Permissions.WRITE))
 
-    database.characters.find_one_and_update(request.id, request.changes)
+    # Hit points, actions and reactions are written behind, the rest now
+    database.characters.update_deferred(request.id, request.changes)
+    listings.invalidate_listing("character", character.folder_id)
 
     await character.broadcast_changes(request.changes)
 
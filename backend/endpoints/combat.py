@@ -1,13 +1,14 @@
 import secrets
 import random
+from bson import ObjectId
 from fastapi import APIRouter
 from typing import Optional
 
-from ..lib import database
+from ..lib import combats, database, expressions
 from ..lib.errors import JsonError
 from ..lib.game import send_message
 from ..lib.utils import require, auth_require
-from ..models.database_models import Combat, Permissions
+from ..models.database_models import Combat, Effect, Permissions
 from ..models.request_models import AuthRequest, GMRequest
 
 
@@ -20,7 +21,7 @@ class NewCombatRequest(GMRequest):
 
 @router.post("/create")
 async def combat_new(request: NewCombatRequest):
-    combat: Combat = database.combats.create({"name": request.name})
+    combat: Combat = combats.create_combat({"name": request.name})
     return {
         "status": "success",
         "combat": combat.model_dump()
@@ -33,7 +34,7 @@ class GetCombatRequest(AuthRequest):
 
 @router.post("/get")
 async def combat_get(request: GetCombatRequest):
-    combat = database.combats.find_one(request.id)
+    combat = combats.get_combat(request.id)
 
     if combat is None:
         raise JsonError("invalid combat id")
@@ -51,13 +52,24 @@ class CombatUpdateRequest(AuthRequest):
 
 @router.post("/update")
 async def combat_update(request: CombatUpdateRequest):
-    combat = require(database.combats.find_one(request.id), "invalid combat id")
+    combat = require(combats.get_combat(request.id), "invalid combat id")
     if not request.requester.is_gm:
         auth_require(combat.has_permission(request.requester.id, "*", Permissions.WRITE))
 
-    database.combats.find_one_and_update(request.id, request.changes)
-
+    updated = require(combats.update_combat(request.id, request.changes), "invalid combat id")
     await combat.broadcast_changes(request.changes)
+
+    # Removing or reordering combatants shouldn't move the turn to someone
+    # else, unless the turn was what was changed
+    sets_turn = any(
+        "turn_index" in fields
+        for fields in request.changes.values() if isinstance(fields, dict)
+    )
+    turn_index = combats.turn_index_of(combat, updated.combatants)
+    if not sets_turn and turn_index != updated.turn_index:
+        turn_update = {"$set": {"turn_index": turn_index}}
+        combats.update_combat(request.id, turn_update)
+        await combat.broadcast_changes(turn_update)
     return {"status": "success"}
 
 
@@ -67,19 +79,64 @@ class CombatSortRequest(AuthRequest):
 
 @router.post("/sort")
 async def combat_sort(request: CombatSortRequest):
-    combat = require(database.combats.find_one(request.id), "invalid combat id")
+    combat = require(combats.get_combat(request.id), "invalid combat id")
     require(len(combat.combatants) > 0, "not enough combatants")
     if not request.requester.is_gm:
         auth_require(combat.has_permission(request.requester.id, "*", Permissions.WRITE))
 
-    combatants = combat.combatants
-    combatants.sort(key=lambda c: c.initiative if c.initiative else 0, reverse=True)
+    combatants = sorted(combat.combatants, key=lambda c: c.initiative if c.initiative else 0, reverse=True)
 
     update = {"$set": {
         "combatants": [c.model_dump() for c in combatants],
+        "turn_index": combats.turn_index_of(combat, combatants),
     }}
 
-    database.combats.find_one_and_update(request.id, update)
+    combats.update_combat(request.id, update)
+    await combat.broadcast_changes(update)
+
+    return {"status": "success"}
+
+
+class RollInitiativeRequest(AuthRequest):
+    id: str
+    formula: str = "2d6"
+
+
+@router.post("/roll-initiative")
+async def combat_roll_initiative(request: RollInitiativeRequest):
+    combat = require(combats.get_combat(request.id), "invalid combat id")
+    require(len(combat.combatants) > 0, "not enough combatants")
+    if not request.requester.is_gm:
+        auth_require(combat.has_permission(request.requester.id, "*", Permissions.WRITE))
+
+    character_ids = {
+        combatant.character_id
+        for combatant in combat.combatants
+        if combatant.character_id is not None and ObjectId.is_valid(combatant.character_id)
+    }
+    characters = {
+        character.id: character
+        for character in database.characters.find({"_id": {"$in": [ObjectId(id) for id in character_ids]}})
+    } if character_ids else {}
+
+    combatants = []
+    for combatant in combat.combatants:
+        character = characters.get(combatant.character_id)
+        try:
+            initiative = expressions.evaluate(request.formula, character.data if character else None)
+        except KeyError as e:
+            raise JsonError(f"unrecognized variable '{e.args[0]}' for {combatant.name}")
+        except Exception:
+            raise JsonError("invalid formula")
+        combatants.append(combatant.model_copy(update={"initiative": initiative}))
+    combatants.sort(key=lambda c: c.initiative, reverse=True)
+
+    update = {"$set": {
+        "combatants": [c.model_dump() for c in combatants],
+        "turn_index": combats.turn_index_of(combat, combatants),
+    }}
+
+    combats.update_combat(request.id, update)
     await combat.broadcast_changes(update)
 
     return {"status": "success"}
@@ -91,7 +148,7 @@ class CombatShuffleRequest(AuthRequest):
 
 @router.post("/shuffle")
 async def combat_sort(request: CombatShuffleRequest):
-    combat = require(database.combats.find_one(request.id), "invalid combat id")
+    combat = require(combats.get_combat(request.id), "invalid combat id")
     require(len(combat.combatants) > 0, "not enough combatants")
     if not request.requester.is_gm:
         auth_require(combat.has_permission(request.requester.id, "*", Permissions.WRITE))
@@ -101,9 +158,10 @@ async def combat_sort(request: CombatShuffleRequest):
 
     update = {"$set": {
         "combatants": [c.model_dump() for c in combatants],
+        "turn_index": combats.turn_index_of(combat, combatants),
     }}
 
-    database.combats.find_one_and_update(request.id, update)
+    combats.update_combat(request.id, update)
     await combat.broadcast_changes(update)
 
     return {"status": "success"}
@@ -115,17 +173,21 @@ class CombatClearRequest(AuthRequest):
 
 @router.post("/clear")
 async def combat_clear(request: CombatClearRequest):
-    combat = require(database.combats.find_one(request.id), "invalid combat id")
+    combat = require(combats.get_combat(request.id), "invalid combat id")
     require(len(combat.combatants) > 0, "not enough combatants")
     if not request.requester.is_gm:
         auth_require(combat.has_permission(request.requester.id, "*", Permissions.WRITE))
 
     update = {"$set": {
         "combatants": [],
+        "turn_index": 0,
+        "round": 1,
     }}
 
-    database.combats.find_one_and_update(request.id, update)
+    combat = combats.update_combat(request.id, update)
     await combat.broadcast_changes(update)
+    # Nothing lasts past the end of the combat
+    await combats.expire(combats.pop_due(combat, everything=True))
 
     return {"status": "success"}
 
@@ -136,10 +198,10 @@ class AnnounceTurnRequest(AuthRequest):
 
 @router.post("/announce-turn")
 async def combat_announce_turn(request: AnnounceTurnRequest):
-    combat = require(database.combats.find_one(request.id), "invalid combat id")
+    combat = require(combats.get_combat(request.id), "invalid combat id")
     auth_require(request.requester.is_gm)
     require(len(combat.combatants) > 0, "not enough combatants")
-    combatant = combat.combatants[0]
+    combatant = combat.current_combatant
     await send_message(
         f'<div class="turn-start">Turn Start: {combatant.name}</div>',
         user=request.requester,
@@ -152,31 +214,24 @@ class ReverseTurnRequest(AuthRequest):
 
 
 @router.post("/reverse-turn")
-async def combat_end_turn(request: ReverseTurnRequest):
-    combat = require(database.combats.find_one(request.id), "invalid combat id")
+async def combat_reverse_turn(request: ReverseTurnRequest):
+    combat = require(combats.get_combat(request.id), "invalid combat id")
     auth_require(request.requester.is_gm)
     require(len(combat.combatants) > 1, "not enough combatants")
-    combatant = combat.combatants[-1]
-
-    database.combats.find_one_and_update(request.id, {
-        "$pull": {
-            "combatants": {
-                "id": combatant.id,
-            },
-        },
-    })
-    database.combats.find_one_and_update(request.id, {
-        "$push": {
-            "combatants": {
-                "$each": [combatant.model_dump()],
-                "$position": 0,
-            }
-        }
-    })
 
-    await combat.pool.broadcast({"type": "reverse-turn", "id": combatant.id})
+    index = combat.turn_index % len(combat.combatants)
+    turn_index = (index - 1) % len(combat.combatants)
+    round = max(1, combat.round - 1) if turn_index > index else combat.round
+    update = {"$set": {"turn_index": turn_index, "round": round}}
+    # Only if nobody else changed the turn since it was read
+    combat = require(
+        combats.update_combat({"id": combat.id, "turn_index": combat.turn_index}, update),
+        "the turn has already changed",
+    )
+
+    await combat.broadcast_changes(update)
     await send_message(
-        f'<div class="turn-start">Turn Start: {combatant.name}</div>',
+        f'<div class="turn-start">Turn Start: {combat.current_combatant.name}</div>',
         user=request.requester,
     )
     return {"status": "success"}
@@ -188,9 +243,10 @@ class EndTurnRequest(AuthRequest):
 
 @router.post("/end-turn")
 async def combat_end_turn(request: EndTurnRequest):
-    combat = require(database.combats.find_one(request.id), "invalid combat id")
+    combat = require(combats.get_combat(request.id), "invalid combat id")
     require(len(combat.combatants) >= 1, "not enough combatants")
-    combatant = combat.combatants[0]
+    index = combat.turn_index % len(combat.combatants)
+    combatant = combat.combatants[index]
     character = database.characters.find_one(combatant.character_id)
     if not request.requester.is_gm:
         if character is not None:
@@ -202,40 +258,98 @@ async def combat_end_turn(request: EndTurnRequest):
         else:
             auth_require(combat.has_permission(request.requester.id, "*", Permissions.WRITE))
 
-    combat = database.combats.find_one_and_update(request.id, {
-        "$pull": {
-            "combatants": {
-                "id": combatant.id,
-            },
-        },
-    })
-    combat = database.combats.find_one_and_update(request.id, {
-        "$push": {
-            "combatants": combatant.model_dump()
-        }
-    })
+    turn_index = (index + 1) % len(combat.combatants)
+    round = combat.round + 1 if turn_index <= index else combat.round
+    update = {"$set": {"turn_index": turn_index, "round": round}}
+    # Only if it is still the turn that permission was checked for
+    combat = require(
+        combats.update_combat({
+            "id": combat.id,
+            "turn_index": combat.turn_index,
+            f"combatants.{index}.id": combatant.id,
+        }, update),
+        "the turn has already changed",
+    )
 
-    next_combatant = combat.combatants[0]
+    next_combatant = combat.current_combatant
     next_character = database.characters.find_one(next_combatant.character_id)
 
-    await combat.pool.broadcast({"type": "end-turn", "id": combatant.id})
+    await combat.broadcast_changes(update)
 
     await send_message(
-        f'<div class="turn-start">Turn Start: {combat.combatants[0].name}</div>',
+        f'<div class="turn-start">Turn Start: {next_combatant.name}</div>',
         user=request.requester,
     )
 
+    # The next character's actions come back along with whatever cooldowns
+    # and effects end now, all sent out together
+    messages = []
     if next_character:
         changes = {"$set": {
             "actions": next_character.max_actions,
             "reactions": next_character.max_reactions,
         }}
-        database.characters.find_one_and_update(next_character.id, changes)
-        await next_character.broadcast_changes(changes)
+        database.characters.update_deferred(next_character.id, changes)
+        messages.append({"type": "update", "changes": changes, "pool": next_character.id})
+    await combats.expire(combats.pop_due(combat), messages)
+
+    return {"status": "success"}
+
+
+class StartCooldownRequest(AuthRequest):
+    id: str
+    character_id: str
+    ability_id: str
+
+
+@router.post("/start-cooldown")
+async def combat_start_cooldown(request: StartCooldownRequest):
+    combat = require(combats.get_combat(request.id), "invalid combat id")
+    character = require(database.characters.find_one(request.character_id), "invalid character id")
+    if not request.requester.is_gm:
+        auth_require(character.has_permission(request.requester.id, "*", Permissions.WRITE))
+    ability = require(character.ability_map.get(request.ability_id), "invalid ability id")
+    require(ability.cooldown > 0, "ability has no cooldown")
+    require(ability.id not in character.cooldowns, "ability is already on cooldown")
+
+    expiry = combats.schedule_expiry(combat, ability.cooldown, character.id, ability_id=ability.id)
+    changes = {"$set": {f"cooldowns.{ability.id}": expiry.round}}
+    database.characters.find_one_and_update(character.id, changes)
+    await character.broadcast_changes(changes)
 
     return {"status": "success"}
 
 
+class AddEffectRequest(AuthRequest):
+    id: str
+    character_id: str
+    name: str
+    description: str = ""
+    rounds: int
+
+
+@router.post("/add-effect")
+async def combat_add_effect(request: AddEffectRequest):
+    combat = require(combats.get_combat(request.id), "invalid combat id")
+    character = require(database.characters.find_one(request.character_id), "invalid character id")
+    if not request.requester.is_gm:
+        auth_require(character.has_permission(request.requester.id, "*", Permissions.WRITE))
+    require(request.rounds > 0, "effects must last at least one round")
+
+    effect_id = secrets.token_hex(12)
+    expiry = combats.schedule_expiry(combat, request.rounds, character.id, effect_id=effect_id)
+    changes = {"$set": {f"effect_map.{effect_id}": Effect(
+        id=effect_id,
+        name=request.name,
+        description=request.description,
+        end_round=expiry.round,
+    ).model_dump()}}
+    database.characters.find_one_and_update(character.id, changes)
+    await character.broadcast_changes(changes)
+
+    return {"status": "success", "id": effect_id}
+
+
 @router.post("/list")
 async def combat_list(request: AuthRequest):
     return {
@@ -259,7 +373,7 @@ async def add_combatant(request: AddCombatantRequest):
     if request.combat_id is None:
         combat = require(database.combats.find_one({}), "no combat")
     else:
-        combat = require(database.combats.find_one(request.combat_id), "invalid combat id")
+        combat = require(combats.get_combat(request.combat_id), "invalid combat id")
 
     auth_require(
         request.requester.is_gm
@@ -286,6 +400,6 @@ async def add_combatant(request: AddCombatantRequest):
             "combatants": combatant
         }
     }
-    database.combats.find_one_and_update(combat.id, update)
+    combats.update_combat(combat.id, update)
     await combat.broadcast_changes(update)
     return {"status": "success", "id": combatant_id}
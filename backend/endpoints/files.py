@@ -1,12 +1,22 @@
+import asyncio
+import secrets
 import shutil
 from fastapi import APIRouter, Form, UploadFile, File
+from fastapi.encoders import jsonable_encoder
 from pathlib import Path
+from typing import Optional
 
-from ..lib import database
+from ..lib import database, listings
+from ..lib.assets import find_references, find_unreferenced, move_references
 from ..lib.errors import AuthError, JsonError
-from ..lib.files import sniff, validate_directory, validate_path, generate_thumbnail, delete_thumbnail
+from ..lib.utils import require
+from ..lib.files import (
+    sniff, scan_directory, validate_directory, validate_path,
+    generate_thumbnails, get_listing_dimensions, delete_tree,
+    generate_tiles_async, load_tile_manifest, needs_tiles
+)
 from ..models.database_models import Session, User, get_pool
-from ..models.request_models import AuthRequest
+from ..models.request_models import AuthRequest, GMRequest
 
 
 router = APIRouter()
@@ -33,14 +43,87 @@ async def files_mkdir(request: CreateFolderRequest):
     return {"status": "success"}
 
 
-def recursive_delete(path: Path):
-    if path.is_dir():
-        for sub_path in list(path.iterdir()):
-            recursive_delete(sub_path)
-        path.rmdir()
-    else:
-        path.unlink()
-        delete_thumbnail(path)
+# Paths currently being deleted, mapped to their job ids
+delete_jobs: dict[Path, str] = {}
+# Images currently being split into tiles, mapped to their job ids
+tile_jobs: dict[Path, str] = {}
+# Strong references to running jobs so they aren't garbage collected
+background_tasks: set[asyncio.Task] = set()
+
+
+def start_background_task(coroutine):
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def run_tile_job(job_id: str, path: Path, requested_path: str):
+    pool = get_pool("files")
+    try:
+        manifest = await generate_tiles_async(path)
+    except Exception as exc:
+        await pool.broadcast({
+            "type": "tiles-failed",
+            "job": job_id,
+            "path": requested_path,
+            "reason": str(exc),
+        })
+        return
+    finally:
+        tile_jobs.pop(path, None)
+
+    await pool.broadcast({
+        "type": "tiles",
+        "job": job_id,
+        "path": requested_path,
+        "manifest": manifest,
+    })
+
+
+def start_tile_job(path: Path, requested_path: str) -> str:
+    job_id = tile_jobs.get(path)
+    if job_id is None:
+        job_id = secrets.token_hex(8)
+        tile_jobs[path] = job_id
+        start_background_task(run_tile_job(job_id, path, requested_path))
+    return job_id
+
+
+async def run_delete_job(job_id: str, path: Path, user_id: str, requested_path: str):
+    loop = asyncio.get_running_loop()
+    pool = get_pool("files")
+
+    def report_progress(deleted: int):
+        asyncio.run_coroutine_threadsafe(pool.broadcast({
+            "type": "delete-progress",
+            "job": job_id,
+            "user": user_id,
+            "path": requested_path,
+            "deleted": deleted,
+        }), loop)
+
+    try:
+        deleted = await asyncio.to_thread(delete_tree, path, report_progress)
+    except OSError as exc:
+        await pool.broadcast({
+            "type": "delete-failed",
+            "job": job_id,
+            "user": user_id,
+            "path": requested_path,
+            "reason": str(exc),
+        })
+        return
+    finally:
+        delete_jobs.pop(path, None)
+
+    await pool.broadcast({
+        "type": "delete",
+        "job": job_id,
+        "user": user_id,
+        "path": requested_path,
+        "deleted": deleted,
+    })
 
 
 class DeleteFileRequest(AuthRequest):
@@ -51,15 +134,17 @@ class DeleteFileRequest(AuthRequest):
 async def delete_file(request: DeleteFileRequest):
     path = validate_path(request.requester, request.path)
     # Check that path is a file or directory that exists
-    if not path.exists():
+    if not path.exists() and not path.is_symlink():
         raise JsonError("path does not exist")
-    recursive_delete(path)
-    await get_pool("files").broadcast({
-        "type": "delete",
-        "user": request.requester.id,
-        "path": request.path,
-    })
-    return {"status": "success"}
+    require(path not in delete_jobs, "path is already being deleted")
+
+    # Delete on a worker thread and respond as soon as the job is accepted
+    job_id = secrets.token_hex(8)
+    delete_jobs[path] = job_id
+    start_background_task(run_delete_job(job_id, path, request.requester.id, request.path))
+
+    # Let the client know which documents will be left with broken art
+    return {"status": "success", "job": job_id, "references": find_references(str(path))}
 
 
 @router.post("/upload")
@@ -83,9 +168,31 @@ async def upload_file(token: str = Form(...), path: str = Form(...), file: Uploa
         "user": requester.id,
         "path": str(Path(path) / file.filename),
     })
+
+    # Split large images such as battle maps into tiles in the background
+    if needs_tiles(resolved_path / file.filename):
+        start_tile_job(resolved_path / file.filename, str(Path(path) / file.filename))
+
     return {"status": "success"}
 
 
+class TilesRequest(AuthRequest):
+    path: str
+
+
+@router.post("/tiles")
+async def file_tiles(request: TilesRequest):
+    path = validate_path(request.requester, request.path)
+    require(path.is_file(), "not a file")
+
+    # Generate missing or outdated tiles, announcing them when they're ready
+    manifest = load_tile_manifest(path)
+    if manifest is None:
+        return {"status": "success", "manifest": None, "job": start_tile_job(path, request.path)}
+
+    return {"status": "success", "manifest": manifest}
+
+
 class MoveFileRequest(AuthRequest):
     src: str
     dst: str
@@ -97,21 +204,59 @@ async def move_file(request: MoveFileRequest):
     src = validate_path(request.requester, request.src)
     dst = validate_path(request.requester, request.dst)
     src.rename(dst)
+
+    # Point documents referencing the old location at the new one
+    changes = move_references(str(src), str(dst))
+    for collection_name in {collection_name for collection_name, _ in changes}:
+        if collection_name in listings.entry_types:
+            listings.invalidate_listings(listings.entry_types[collection_name])
+    for (collection_name, document_id), fields in changes.items():
+        # Tokens are updated through their map
+        if collection_name == "tokens":
+            token = database.tokens.find_one(document_id)
+            if token is None:
+                continue
+            document_id = token.map_id
+            fields = {f"tokens.{token.id}.{field}": value for field, value in fields.items()}
+        await get_pool(document_id).broadcast(jsonable_encoder({
+            "type": "update",
+            "changes": {"$set": fields},
+        }))
+
     await get_pool("files").broadcast({
         "type": "rename",
         "user": request.requester.id,
         "src": str(src),
         "dst": str(dst),
     })
-    return {"status": "success"}
+    return {"status": "success", "updated": len(changes)}
+
+
+@router.post("/unreferenced")
+async def unreferenced_files(request: GMRequest):
+    user_root = request.requester.file_root
+    results, total_size = await asyncio.to_thread(find_unreferenced, user_root)
+    return {
+        "status": "success",
+        "files": [
+            ("/" + str(Path(path).relative_to(user_root)), size)
+            for path, size in results
+        ],
+        "total_size": total_size,
+    }
 
 
 class ListFilesRequest(AuthRequest):
     path: str
+    prefix: Optional[str] = None
+    after: Optional[str] = None
+    limit: Optional[int] = None
+    fast: bool = False
 
 
 @router.post("/list")
 async def list_files(request: ListFilesRequest):
+    require(request.limit is None or request.limit > 0, "limit must be positive")
     # Validate path
     path = validate_directory(request.requester, request.path)
     # Make path relative to user root
@@ -122,25 +267,59 @@ async def list_files(request: ListFilesRequest):
     else:
         returned_path = "/" + str(path.relative_to(user_root))
 
-    results = [
-        (
-            sniff(subpath),
-            "/" + str(subpath.relative_to(user_root))
-        )
-        for subpath in path.iterdir()
-    ]
-    results.sort()
-
-    for file_type, file_path in results:
-        if file_type == "image/gif":
-            pass # Don't thumbnail GIFs
-        elif file_type == "image/svg":
-            generate_thumbnail(user_root / file_path.lstrip("/"), svg=True)
-        elif file_type.startswith("image/"):
-            generate_thumbnail(user_root / file_path.lstrip("/"))
+    page, next_cursor = scan_directory(path, request.prefix, request.after, request.limit)
+
+    # In fast mode only directories are identified, file types are left
+    # as None for the client to fill in through /sniff
+    if request.fast:
+        dimensions = {}
+        results = [
+            (
+                "directory" if is_dir else None,
+                "/" + str(Path(entry.path).relative_to(user_root))
+            )
+            for is_dir, entry in page
+        ]
+    else:
+        results = [
+            (
+                "directory" if is_dir else sniff(Path(entry.path)),
+                "/" + str(Path(entry.path).relative_to(user_root))
+            )
+            for is_dir, entry in page
+        ]
+        generate_thumbnails(user_root, results)
+        dimensions = get_listing_dimensions(user_root, results)
 
     return {
         "status": "success",
         "path": returned_path,
-        "files": results
+        "files": results,
+        "dimensions": dimensions,
+        "next": next_cursor,
+    }
+
+
+class SniffFilesRequest(AuthRequest):
+    paths: list[str]
+
+
+@router.post("/sniff")
+async def sniff_files(request: SniffFilesRequest):
+    user_root = request.requester.file_root
+    results = []
+    for requested_path in request.paths:
+        path = validate_path(request.requester, requested_path)
+        try:
+            file_type = sniff(path)
+        except FileNotFoundError:
+            continue
+        results.append((file_type, "/" + str(path.relative_to(user_root))))
+
+    generate_thumbnails(user_root, results)
+
+    return {
+        "status": "success",
+        "files": results,
+        "dimensions": get_listing_dimensions(user_root, results),
     }
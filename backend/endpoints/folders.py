@@ -1,39 +1,66 @@
+import bisect
+import hashlib
+import json
 from bson import ObjectId
 from bson.errors import InvalidId
-from fastapi import APIRouter
+from fastapi import APIRouter, Header, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
 from pydantic.functional_validators import AfterValidator
 from typing import Annotated, Optional
 from enum import Enum
 
-from ..lib import database
+from ..lib import database, listings
 from ..lib.utils import require, auth_require, pluralize
-from ..models.database_models import Permissions, get_pool, Entry, Folder
+from ..models.database_models import (
+    Permissions, get_pool, Entry, EntrySummary, AbilitySummary, Folder, FolderSummary
+)
 from ..models.request_models import AuthRequest, GMRequest
 
 
 def delete_folder(collection: str, folder: Folder):
-    # Delete the folder itself
+    # Delete the folder itself and every folder below it
     folders: database.DocumentCollection[Folder] = getattr(database, f"{collection}_folders")
-    folders.delete_one(folder.id)
-    # Delete all entries in this folder
+    folders.delete_many({"$or": [{"_id": ObjectId(folder.id)}, {"ancestors": folder.id}]})
+    # Delete all entries in this folder or below it
     entryCollection: database.DocumentCollection[Entry] = getattr(database, f"{pluralize(collection)}")
-    entryCollection.delete_many({"folder_id": folder.id})
-    # Recursively delete all child folders
-    for subfolder in folders.find({"parent_id": folder.id}):
-        delete_folder(collection, subfolder)
+    entryCollection.delete_many({"ancestors": folder.id})
 
 
 def set_folder_permissions(collection: str, folder: Folder, permissions: dict):
+    # Apply the permissions to all entries in this folder or below it
     entryCollection: database.DocumentCollection[Entry] = getattr(database, f"{pluralize(collection)}")
-    entryCollection.update_many({"folder_id": folder.id}, {"$set": {"permissions": permissions}})
-
-    folders: database.DocumentCollection[Folder] = getattr(database, f"{collection}_folders")
-    for subfolder in folders.find({"parent_id": folder.id}):
-        set_folder_permissions(collection, subfolder, permissions)
+    entryCollection.update_many({"ancestors": folder.id}, {"$set": {"permissions": permissions}})
 
     return {"status": "success"}
 
 
+def find_folder(folders: database.DocumentCollection[Folder], folder_id: str) -> Folder:
+    """
+    Find a folder by its id or its alternate id.
+    """
+    try:
+        return require(folders.find_one({"$or": [
+            {"_id": ObjectId(folder_id)},
+            {"alternate_id": folder_id},
+        ]}), "invalid folder id")
+    except InvalidId:
+        return require(folders.find_one({
+            "alternate_id": folder_id
+        }), "invalid folder id")
+
+
+def rebase_ancestors(collection: database.DocumentCollection, folder: Folder, lineage: list[str]):
+    """
+    Replace the ancestors above the given folder with its new lineage, for
+    every document below it.
+    """
+    collection.update_many({"ancestors": folder.id}, [{"$set": {"ancestors": {"$concatArrays": [
+        lineage,
+        {"$slice": ["$ancestors", len(folder.ancestors) + 1, {"$size": "$ancestors"}]},
+    ]}}}])
+
+
 router = APIRouter()
 
 
@@ -46,6 +73,14 @@ def validate_entry_type(value: str):
 EntryType = Annotated[str, AfterValidator(validate_entry_type)]
 
 
+# The fields of each entry type needed to render it in a folder listing
+summary_models = {
+    "character": EntrySummary,
+    "ability": AbilitySummary,
+    "note": EntrySummary,
+}
+
+
 class FolderMoveRequest(AuthRequest):
     entry_id: Optional[str] = None
     folder_id: Optional[str] = None
@@ -57,10 +92,12 @@ async def folder_move(request: FolderMoveRequest, entryType: EntryType):
     folders: database.DocumentCollection[Folder] = getattr(database, f"{entryType}_folders")
     entryCollection: database.DocumentCollection[Entry] = getattr(database, f"{pluralize(entryType)}")
 
+    dst_folder = None
     if request.dst_id is not None:
         dst_folder = require(folders.find_one(request.dst_id), "invalid folder id")
         if not request.requester.is_gm:
             auth_require(dst_folder.has_permission(request.requester.id, "*", Permissions.WRITE))
+    dst_lineage = dst_folder.lineage if dst_folder is not None else []
 
     require(request.entry_id or request.folder_id, "no src specified")
     require(not (request.entry_id and request.folder_id), "both folder and entry id specified")
@@ -70,7 +107,11 @@ async def folder_move(request: FolderMoveRequest, entryType: EntryType):
         require(entry.folder_id != request.dst_id, "src and dst folder must differ")
         if not request.requester.is_gm:
             auth_require(entry.has_permission(request.requester.id, "*", Permissions.OWNER))
-        entryCollection.find_one_and_update(request.entry_id, {"$set": {"folder_id": request.dst_id}})
+        entryCollection.find_one_and_update(request.entry_id, {"$set": {
+            "folder_id": request.dst_id,
+            "ancestors": dst_lineage,
+        }})
+        listings.invalidate_listing(entryType, entry.folder_id, request.dst_id)
         await entry.pool.broadcast({
             "type": "move",
             "src": entry.folder_id,
@@ -86,12 +127,19 @@ async def folder_move(request: FolderMoveRequest, entryType: EntryType):
         })
 
     if request.folder_id is not None:
-        require(request.folder_id != request.dst_id, "folder cannot contain itself")
+        require(request.folder_id not in dst_lineage, "folder cannot contain itself")
         folder = require(folders.find_one(request.folder_id), "invalid folder id")
         require(folder.parent_id != request.dst_id, "src and dst folder must differ")
         if not request.requester.is_gm:
             auth_require(folder.has_permission(request.requester.id, "*", Permissions.OWNER))
-        folders.find_one_and_update(request.folder_id, {"$set": {"parent_id": request.dst_id}})
+        folders.find_one_and_update(request.folder_id, {"$set": {
+            "parent_id": request.dst_id,
+            "ancestors": dst_lineage,
+        }})
+        # Everything below the folder keeps its path relative to it
+        rebase_ancestors(folders, folder, dst_lineage + [folder.id])
+        rebase_ancestors(entryCollection, folder, dst_lineage + [folder.id])
+        listings.invalidate_listing(entryType, folder.parent_id, request.dst_id, folder.id)
         await get_pool(pluralize(entryType)).broadcast({
             "type": "movedir",
             "src": folder.parent_id,
@@ -104,24 +152,82 @@ async def folder_move(request: FolderMoveRequest, entryType: EntryType):
 
 class ListRequest(AuthRequest):
     folder_id: Optional[str] = None
+    full: bool = False
+    limit: Optional[int] = None
+    after: Optional[str] = None
+
+
+def encode_cursor(entry: EntrySummary) -> str:
+    return f"{entry.id}/{entry.name or ''}"
+
+
+def decode_cursor(cursor: str) -> tuple[str, str]:
+    """
+    Returns the (name, id) of the last entry on the previous page.
+    """
+    id, separator, name = cursor.partition("/")
+    require(separator and ObjectId.is_valid(id), "invalid cursor")
+    return name, id
+
+
+def load_listing(entryType: str, folder_id: Optional[str]) -> listings.Listing:
+    """
+    Load the listing of a folder, or the root for None, as a GM sees it.
+    """
+    folders: database.DocumentCollection[Folder] = getattr(database, f"{entryType}_folders")
+    entryCollection: database.DocumentCollection[Entry] = getattr(database, f"{pluralize(entryType)}")
+
+    if folder_id is not None:
+        folder = find_folder(folders, folder_id)
+        listing = listings.Listing(folder.id, folder.name, folder.parent_id, [], [])
+    else:
+        listing = listings.Listing(None, "/", None, [], [])
+
+    listing.subfolders = folders.find_projected({"parent_id": listing.id}, FolderSummary, sort=[("name", 1)])
+    listing.entries = entryCollection.find_projected(
+        {"folder_id": listing.id, "temporary": {"$ne": True}},
+        summary_models[entryType],
+        sort=[("name", 1), ("_id", 1)],
+    )
+    return listing
 
 
 @router.post("/{entryType}/list")
 async def folder_list(request: ListRequest, entryType: EntryType):
     folders: database.DocumentCollection[Folder] = getattr(database, f"{entryType}_folders")
     entryCollection: database.DocumentCollection[Entry] = getattr(database, f"{pluralize(entryType)}")
+    require(request.limit is None or request.limit > 0, "limit must be positive")
+
+    if not request.full:
+        listing = listings.get_listing(entryType, request.folder_id)
+        if listing is None:
+            listing = load_listing(entryType, request.folder_id)
+            listings.store_listing(entryType, request.folder_id, listing)
+
+        # The cached listing is everything, so narrow it to what the
+        # requester can see
+        def visible(summary: EntrySummary) -> bool:
+            return request.requester.is_gm or summary.has_permission(request.requester.id, "*", Permissions.READ)
+
+        entries = [entry for entry in listing.entries if visible(entry)]
+        start = 0
+        if request.after is not None:
+            start = bisect.bisect_right(entries, decode_cursor(request.after), key=lambda e: (e.name or "", e.id))
+        end = len(entries) if request.limit is None else start + request.limit
+        page = entries[start:end]
+
+        return {
+            "status": "success",
+            "name": listing.name,
+            "parent_id": listing.parent_id,
+            "subfolders": [(folder.id, folder.name) for folder in listing.subfolders if visible(folder)],
+            "entries": [entry.model_dump() for entry in page],
+            "total": len(entries),
+            "next": encode_cursor(page[-1]) if end < len(entries) else None,
+        }
 
     if request.folder_id is not None:
-        try:
-            folder = require(folders.find_one({"$or": [
-                {"_id": ObjectId(request.folder_id)},
-                {"alternate_id": request.folder_id},
-            ]}), "invalid folder id")
-        except InvalidId:
-            folder = require(folders.find_one({
-                "alternate_id": request.folder_id
-            }), "invalid folder id")
-
+        folder = find_folder(folders, request.folder_id)
         folder_id = folder.id
         folder_name = folder.name
         parent_id = folder.parent_id
@@ -130,27 +236,128 @@ async def folder_list(request: ListRequest, entryType: EntryType):
         folder_name = "/"
         parent_id = None
 
-    subfolders = []
-    for folder in folders.find({"parent_id": folder_id}):
-        if request.requester.is_gm or folder.has_permission(request.requester.id, level=Permissions.READ):
-            subfolders.append((folder.id, folder.name))
+    folder_filter = {"parent_id": folder_id}
+    entry_filter = {"folder_id": folder_id, "temporary": {"$ne": True}}
+    # Only load what the requester can see
+    if not request.requester.is_gm:
+        permission_filter = EntrySummary.permission_filter(request.requester.id, level=Permissions.READ)
+        folder_filter = {"$and": [folder_filter, permission_filter]}
+        entry_filter = {"$and": [entry_filter, permission_filter]}
+
+    subfolders = [
+        (folder.id, folder.name)
+        for folder in folders.find_projected(folder_filter, EntrySummary)
+    ]
     subfolders.sort(key=lambda f: f[1])
 
-    entries = []
-    for entry in entryCollection.find({"folder_id": folder_id, "temporary": {"$ne": True}}):
-        if request.requester.is_gm or entry.has_permission(request.requester.id, level=Permissions.READ):
-            entries.append(entry.model_dump())
-    entries.sort(key=lambda entry: entry["name"])
+    total = entryCollection.collection.count_documents(entryCollection.pre_process_filter(entry_filter))
+    page_filter = entry_filter
+    if request.after is not None:
+        name, id = decode_cursor(request.after)
+        # Walk the (folder_id, name) index from where the last page ended
+        page_filter = {"$and": [entry_filter, {"$or": [
+            {"name": {"$gt": name}},
+            {"name": name, "_id": {"$gt": ObjectId(id)}},
+        ]}]}
+    # Fetch one past the page to tell whether there is another
+    documents = entryCollection.find(
+        page_filter,
+        sort=[("name", 1), ("_id", 1)],
+        limit=request.limit + 1 if request.limit is not None else 0,
+    )
+    next_cursor = None
+    if request.limit is not None and len(documents) > request.limit:
+        documents = documents[:request.limit]
+        next_cursor = encode_cursor(documents[-1])
+    entries = [entry.model_dump() for entry in documents]
 
     return {
         "status": "success",
         "name": folder_name,
         "parent_id": parent_id,
         "subfolders": subfolders,
-        "entries": entries
+        "entries": entries,
+        "total": total,
+        "next": next_cursor,
     }
 
 
+class TreeRequest(AuthRequest):
+    folder_id: Optional[str] = None
+    depth: Optional[int] = None
+
+
+@router.post("/{entryType}/tree")
+async def folder_tree(request: TreeRequest, entryType: EntryType, if_none_match: Optional[str] = Header(None)):
+    folders: database.DocumentCollection[Folder] = getattr(database, f"{entryType}_folders")
+    entryCollection: database.DocumentCollection[Entry] = getattr(database, f"{pluralize(entryType)}")
+    require(request.depth is None or request.depth >= 0, "depth must not be negative")
+
+    if request.folder_id is not None:
+        folder = find_folder(folders, request.folder_id)
+        root = {"id": folder.id, "name": folder.name, "parent_id": folder.parent_id}
+        base_depth = len(folder.lineage)
+        folder_filter = {"ancestors": folder.id}
+        entry_filter = {"ancestors": folder.id, "temporary": {"$ne": True}}
+    else:
+        root = {"id": None, "name": "/", "parent_id": None}
+        base_depth = 0
+        folder_filter = {}
+        entry_filter = {"temporary": {"$ne": True}}
+    root["subfolders"] = []
+    root["entries"] = []
+
+    # The ancestors arrays give each document's depth, so a depth limit is
+    # a bound on their length
+    if request.depth is not None:
+        folder_filter[f"ancestors.{base_depth + request.depth - 1}"] = {"$exists": False}
+        entry_filter[f"ancestors.{base_depth + request.depth}"] = {"$exists": False}
+
+    # Only load what the requester can see
+    if not request.requester.is_gm:
+        permission_filter = EntrySummary.permission_filter(request.requester.id, level=Permissions.READ)
+        folder_filter = {"$and": [folder_filter, permission_filter]}
+        entry_filter = {"$and": [entry_filter, permission_filter]}
+
+    nodes = {root["id"]: root}
+    subtree = []
+    if request.depth != 0:
+        subtree = folders.find_projected(folder_filter, FolderSummary, sort=[("name", 1)])
+    for subfolder in subtree:
+        nodes[subfolder.id] = {"id": subfolder.id, "name": subfolder.name, "subfolders": [], "entries": []}
+    # Folders hidden from the requester take their descendants with them,
+    # as those are only attached to the hidden node
+    for subfolder in subtree:
+        parent = nodes.get(subfolder.parent_id)
+        if parent is not None:
+            parent["subfolders"].append(nodes[subfolder.id])
+
+    # Group the entry summaries by folder in one aggregation
+    summary_model = summary_models[entryType]
+    projection = {name: 1 for name in summary_model.model_fields if name != "id"}
+    projection["folder_id"] = 1
+    for group in entryCollection.collection.aggregate([
+        {"$match": entryCollection.pre_process_filter(entry_filter)},
+        {"$project": projection},
+        {"$sort": {"name": 1}},
+        {"$group": {"_id": "$folder_id", "entries": {"$push": "$$ROOT"}}},
+    ]):
+        node = nodes.get(group["_id"])
+        if node is None:
+            continue
+        node["entries"] = [
+            entryCollection.post_process_result(document, summary_model).model_dump()
+            for document in group["entries"]
+        ]
+
+    # Let clients skip the payload when the tree they have is current
+    content = jsonable_encoder({"status": "success", "tree": root})
+    etag = '"' + hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest() + '"'
+    if if_none_match == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return JSONResponse(content, headers={"ETag": etag})
+
+
 class FolderRenameRequest(AuthRequest):
     id: str
     name: str
@@ -165,6 +372,7 @@ async def folder_rename(request: FolderRenameRequest, entryType: EntryType):
         auth_require(folder.has_permission(request.requester.id, "*", Permissions.OWNER))
 
     folders.find_one_and_update(request.id, {"$set": {"name": request.name}})
+    listings.invalidate_listing(entryType, folder.parent_id, folder.id)
 
     await get_pool(pluralize(entryType)).broadcast({
         "type": "renamedir",
@@ -183,14 +391,17 @@ class FolderCreateRequest(AuthRequest):
 async def folder_create(request: FolderCreateRequest, entryType: EntryType):
     folders: database.DocumentCollection[Folder] = getattr(database, f"{entryType}_folders")
 
+    ancestors = []
     if request.parent is not None:
-        require(folders.find_one(request.parent), "invalid folder id")
+        parent = require(folders.find_one(request.parent), "invalid folder id")
+        ancestors = parent.lineage
 
-    options = {"name": request.name, "parent_id": request.parent}
+    options = {"name": request.name, "parent_id": request.parent, "ancestors": ancestors}
     if not request.requester.is_gm:
         options["permissions"] = {"*": {"*": Permissions.READ}, request.requester.id: {"*": Permissions.OWNER}}
 
     folder = folders.create(options)
+    listings.invalidate_listing(entryType, request.parent)
 
     await get_pool(pluralize(entryType)).broadcast({
         "type": "mkdir",
@@ -215,6 +426,7 @@ async def folder_delete(request: FolderDeleteRequest, entryType: EntryType):
         auth_require(folder.has_permission(request.requester.id, "*", Permissions.OWNER))
 
     delete_folder(entryType, folder)
+    listings.invalidate_listings(entryType)
 
     await get_pool(pluralize(entryType)).broadcast({
         "type": "rmdir",
@@ -236,6 +448,7 @@ async def folder_alt_id(request: FolderSetAltIdRequest, entryType: EntryType):
         request.folder_id,
         {"$set": {"alternate_id": request.alternate_id}}
     ), "invalid folder_id")
+    listings.invalidate_listings(entryType)
     return {"status": "success"}
 
 
@@ -250,5 +463,6 @@ async def folder_set_permissions(request: FolderUpdatePermissionsRequest, entryT
     folder = require(folders.find_one(request.folder_id), "invalid folder id")
 
     set_folder_permissions(entryType, folder, request.permissions)
+    listings.invalidate_listings(entryType)
 
     return {"status": "success"}
@@ -1,15 +1,120 @@
-import shapely
+import json
+import math
+from bson import ObjectId
 from fastapi import APIRouter
-
-from ..lib import database
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from pydantic import Field
+from typing import Iterator, Optional
+
+from . import ws_handlers
+from ..lib import database, fog, geometry, movement, spatial, temporary
+from ..lib.errors import AuthError, JsonError
 from ..lib.utils import require, auth_require
-from ..models.database_models import Permissions, Polygon, get_pool
+from ..models.database_models import Character, Connection, EntrySummary, Layer, Map, Permissions, ScaleType, Token, get_pool
 from ..models.request_models import AuthRequest, GMRequest
 
 
 router = APIRouter()
 
 
+def find_map(id: str) -> Optional[Map]:
+    """
+    Load a map without its revealed areas, which can be large and are only
+    needed by lib.fog, which decodes them off the event loop.
+    """
+    if not ObjectId.is_valid(id):
+        return None
+    return database.maps.find_one(id, {"revealed_areas": 0})
+
+
+def find_tokens(map_id: str, token_ids: list[str]) -> list[Token]:
+    """
+    Load tokens found in a map's spatial index, where they are now rather
+    than where they were last written, the way the index has them.
+    """
+    tokens = database.tokens.find({"_id": {"$in": [ObjectId(token_id) for token_id in token_ids]}})
+    unwritten = movement.get_unwritten(map_id)
+    for token in tokens:
+        if token.id in unwritten:
+            token.x, token.y = unwritten[token.id]
+    return tokens
+
+
+def apply_token_changes(map_id: str, changes: dict) -> dict:
+    """
+    Apply the tokens.<id> keys of a map update to the tokens collection, one
+    write per token. Returns the rest of the changes, which apply to the map.
+    """
+    map_changes = {}
+    token_changes: dict[str, dict[str, dict]] = {}
+    for operator, fields in changes.items():
+        if not isinstance(fields, dict):
+            map_changes[operator] = fields
+            continue
+        for key, value in fields.items():
+            path = key.split(".", 2)
+            if path[0] != "tokens":
+                map_changes.setdefault(operator, {})[key] = value
+                continue
+            require(len(path) > 1 and ObjectId.is_valid(path[1]), "invalid token id")
+            # Written directly, so moves still pending would be stale
+            movement.discard_moves(map_id, path[1])
+            if len(path) == 3:
+                token_changes.setdefault(path[1], {}).setdefault(operator, {})[path[2]] = value
+            elif operator == "$set":
+                token = {field: value for field, value in value.items() if field != "id"}
+                token["map_id"] = map_id
+                database.tokens.upsert({"id": path[1], "map_id": map_id}, {"$set": token})
+                spatial.refresh_token(map_id, path[1])
+            elif operator == "$unset":
+                token = database.tokens.find_one({"id": path[1], "map_id": map_id})
+                if token is not None:
+                    database.tokens.delete_one(token.id)
+                    temporary.delete_temporary_characters([token.character_id])
+                spatial.remove_token(map_id, path[1])
+            else:
+                require(False, f"unsupported token operator {operator}")
+
+    for token_id, update in token_changes.items():
+        token = database.tokens.find_one_and_update({"id": token_id, "map_id": map_id}, update)
+        if token is not None:
+            spatial.update_token(map_id, token)
+
+    return map_changes
+
+
+def stream_map(
+    map: Map,
+    reveal_revision: int,
+    revealed_chunks: dict[str, Optional[dict]],
+    unwritten: dict[str, tuple[float, float]],
+) -> Iterator[str]:
+    """
+    Write out a map with its tokens, reading tokens a layer at a time as they
+    are sent rather than loading them all first. Tokens that have moved since
+    they were written are sent where they are now.
+    """
+    content = map.model_dump(exclude={"revealed_areas"})
+    content["reveal_revision"] = reveal_revision
+    content["revealed_chunks"] = revealed_chunks
+    map_json = json.dumps(jsonable_encoder(content))
+    yield '{"status": "success", "map": ' + map_json[:-1] + ', "tokens": {'
+
+    # Fill in defaults the way loading each token through the model would
+    defaults = jsonable_encoder(Token().model_dump(exclude={"id"}))
+    cursor = database.tokens.collection.find({"map_id": map.id}, sort=[("layer", 1)])
+    for index, document in enumerate(cursor):
+        token_id = document.pop("_id").binary.hex()
+        token = {**defaults, **document, "id": token_id}
+        if token_id in unwritten:
+            token["x"], token["y"] = unwritten[token_id]
+        prefix = ", " if index else ""
+        yield f'{prefix}"{token_id}": {json.dumps(jsonable_encoder(token))}'
+
+    yield "}}}"
+
+
 @router.post("/create")
 async def map_create(request: GMRequest):
     map = database.maps.create({"name": "New Map"})
@@ -27,11 +132,22 @@ class MapGetRequest(AuthRequest):
 
 @router.post("/get")
 async def map_get(request: MapGetRequest):
-    map = require(database.maps.find_one(request.id), "invalid map id")
+    map = require(find_map(request.id), "invalid map id")
+    auth_require(request.requester.is_gm or map.has_permission(request.requester.id, "*", Permissions.READ))
+    revision, chunks = await fog.get_fog_chunks(map)
+    unwritten = movement.get_unwritten(map.id)
+    return StreamingResponse(stream_map(map, revision, chunks, unwritten), media_type="application/json")
+
+
+@router.post("/fog")
+async def map_fog(request: MapGetRequest):
+    map = require(find_map(request.id), "invalid map id")
     auth_require(request.requester.is_gm or map.has_permission(request.requester.id, "*", Permissions.READ))
+    revision, chunks = await fog.get_fog_chunks(map)
     return {
         "status": "success",
-        "map": map.model_dump()
+        "revision": revision,
+        "chunks": chunks,
     }
 
 
@@ -41,10 +157,16 @@ class MapDeleteRequest(AuthRequest):
 
 @router.post("/delete")
 async def map_delete(request: MapDeleteRequest):
-    map = require(database.maps.find_one(request.id), "invalid map id")
+    map = require(find_map(request.id), "invalid map id")
     if not request.requester.is_gm:
         auth_require(map.has_permission(request.requester.id, "*", Permissions.OWNER))
     database.maps.delete_one(map.id)
+    character_ids = database.tokens.collection.distinct("character_id", {"map_id": map.id})
+    database.tokens.delete_many({"map_id": map.id})
+    temporary.delete_temporary_characters(character_ids)
+    fog.forget_fog(map.id)
+    spatial.forget_index(map.id)
+    movement.forget_moves(map.id)
     await get_pool("maps").broadcast({
         "type": "delete",
         "id": map.id,
@@ -59,13 +181,44 @@ class MapUpdateRequest(AuthRequest):
 
 @router.post("/update")
 async def map_update(request: MapUpdateRequest):
-    map = require(database.maps.find_one(request.id), "invalid map id")
+    map = require(find_map(request.id), "invalid map id")
     if not request.requester.is_gm:
         auth_require(map.has_permission(request.requester.id, "*", Permissions.WRITE))
 
-    database.maps.find_one_and_update(request.id, request.changes)
-
-    await map.broadcast_changes(request.changes)
+    # Where changed tokens were, for connections only watching part of the map
+    if any(map.id in connection.viewports for connection in map.pool):
+        index = spatial.get_index(map.id)
+        before = {token_id: index.bounds(token_id) for token_id in spatial.changed_token_ids(request.changes)}
+    else:
+        before = {}
+
+    # Clients address tokens as tokens.<id> within the map, which now live in
+    # their own collection
+    map_changes = apply_token_changes(map.id, request.changes)
+    # Direct edits to the revealed areas replace any pending reveal and hide,
+    # and move the revision past every one handed out
+    if any(
+        key.split(".")[0] in ("revealed_areas", "reveal_revision")
+        for fields in map_changes.values() if isinstance(fields, dict)
+        for key in fields
+    ):
+        revision = fog.next_revision(map)
+        for changes in (map_changes, request.changes):
+            for fields in changes.values():
+                if isinstance(fields, dict):
+                    fields.pop("reveal_revision", None)
+            changes.setdefault("$set", {})["reveal_revision"] = revision
+        fog.forget_fog(map.id)
+    if any(
+        key.split(".")[0] == "permissions"
+        for fields in map_changes.values() if isinstance(fields, dict)
+        for key in fields
+    ):
+        movement.forget_movers(map.id)
+    if map_changes:
+        database.maps.update_one(map.id, map_changes)
+
+    await spatial.broadcast_map_changes(map.id, request.changes, before)
     return {"status": "success"}
 
 
@@ -76,27 +229,102 @@ class DeleteTokenRequest(AuthRequest):
 
 @router.post("/delete-token")
 async def map_delete_token(request: DeleteTokenRequest):
-    map = require(database.maps.find_one(request.map), "invalid map id")
+    map = require(find_map(request.map), "invalid map id")
     if not request.requester.is_gm:
         auth_require(map.has_permission(request.requester.id, "*", Permissions.WRITE))
 
-    token = require(map.tokens.get(request.token_id), "invalid token id")
+    require(ObjectId.is_valid(request.token_id), "invalid token id")
+    token = require(database.tokens.find_one({"id": request.token_id, "map_id": map.id}), "invalid token id")
 
-    character = database.characters.find_one(token.character_id)
-    if character is not None and character.temporary:
-        database.characters.delete_one(character.id)
+    temporary.delete_temporary_characters([token.character_id])
 
-    changes = {
+    database.tokens.delete_one(token.id)
+    spatial.remove_token(map.id, token.id)
+    movement.discard_moves(map.id, token.id)
+    await map.broadcast_changes({
         "$unset": {
             f"tokens.{token.id}": None,
         },
-    }
-    database.maps.find_one_and_update(request.map, changes)
-    await map.broadcast_changes(changes)
+    })
 
     return {"status": "success"}
 
 
+# Most tokens spawned by one request
+MAX_SPAWN_COUNT = 200
+
+
+class MapSpawnRequest(AuthRequest):
+    id: str
+    character_id: str
+    count: int = 1
+    # Center of the formation
+    x: float
+    y: float
+    # One of grid, line or circle
+    formation: str = "grid"
+    layer: Layer = Layer.CHARACTERS
+
+
+@router.post("/spawn")
+async def map_spawn(request: MapSpawnRequest):
+    """
+    Place tokens for count temporary copies of a character, in a formation
+    around a point.
+    """
+    map = require(find_map(request.id), "invalid map id")
+    if not request.requester.is_gm:
+        auth_require(map.has_permission(request.requester.id, "*", Permissions.WRITE))
+    template: Character = require(database.characters.find_one(request.character_id), "invalid character id")
+    if not request.requester.is_gm:
+        auth_require(template.has_permission(request.requester.id, "*", Permissions.READ))
+    require(1 <= request.count <= MAX_SPAWN_COUNT, f"count must be between 1 and {MAX_SPAWN_COUNT}")
+
+    footprint = template.size * map.squareSize
+    try:
+        positions = spatial.formation_positions(request.formation, request.count, footprint, request.x, request.y)
+    except ValueError:
+        raise JsonError("invalid formation")
+
+    document = template.model_dump(exclude={"id"})
+    document.update(folder_id=None, ancestors=[], temporary=True)
+    character_ids = database.characters.insert_many([
+        {**document, "name": f"{template.name} - {index + 1}"}
+        for index in range(request.count)
+    ])
+
+    top = database.tokens.collection.find_one({"map_id": map.id}, {"z": 1}, sort=[("z", -1)])
+    z = top.get("z", 0) if top is not None else 0
+    documents = [
+        {
+            "name": f"{template.name} - {index + 1}",
+            "src": template.image,
+            "x": x,
+            "y": y,
+            "z": z + index + 1,
+            "layer": request.layer,
+            "width": footprint * template.scale,
+            "height": footprint * template.scale,
+            "hitbox_width": footprint,
+            "hitbox_height": footprint,
+            "scale_type": ScaleType.ABSOLUTE,
+            "character_id": character_id,
+            "map_id": map.id,
+        }
+        for index, (character_id, (x, y)) in enumerate(zip(character_ids, positions))
+    ]
+    tokens = [
+        Token.model_validate({**document, "id": token_id})
+        for document, token_id in zip(documents, database.tokens.insert_many(documents))
+    ]
+    for token in tokens:
+        spatial.update_token(map.id, token)
+
+    changes = {"$set": {f"tokens.{token.id}": token.model_dump() for token in tokens}}
+    await spatial.broadcast_map_changes(map.id, changes, {})
+    return {"status": "success", "tokens": {token.id: token for token in tokens}}
+
+
 class MapPingRequest(AuthRequest):
     id: str
     x: float
@@ -105,7 +333,7 @@ class MapPingRequest(AuthRequest):
 
 @router.post("/ping")
 async def map_ping(request: MapPingRequest):
-    map = require(database.maps.find_one(request.id), "invalid map id")
+    map = require(find_map(request.id), "invalid map id")
     if not request.requester.is_gm:
         auth_require(map.has_permission(request.requester.id, "ping", Permissions.WRITE))
     await map.pool.broadcast({"type": "ping", "x": request.x, "y": request.y})
@@ -114,49 +342,150 @@ async def map_ping(request: MapPingRequest):
 
 @router.post("/list")
 async def map_list(request: AuthRequest):
-    maps = []
     if request.requester.is_gm:
-        for map in database.maps.find():
-            maps.append((map.id, map.name))
+        map_filter = {}
     else:
-        for map in database.maps.find():
-            if map.has_permission(request.requester.id, level=Permissions.READ):
-                maps.append((map.id, map.name))
+        map_filter = EntrySummary.permission_filter(request.requester.id, level=Permissions.READ)
+    maps = [(map.id, map.name) for map in database.maps.find_projected(map_filter, EntrySummary)]
     return {"status": "success", "maps": maps}
 
 
 class MapPolygonRequest(AuthRequest):
     id: str
-    area: Polygon
+    # Left as coordinates here and built into a polygon in the geometry pool
+    area: list[tuple[float, float]]
 
 
 @router.post("/reveal")
 async def map_reveal(request: MapPolygonRequest):
-    map = require(database.maps.find_one(request.id), "invalid map id")
+    map = require(find_map(request.id), "invalid map id")
     if not request.requester.is_gm:
         auth_require(map.has_permission(request.requester.id, "reveal", Permissions.WRITE))
 
-    if map.revealed_areas is None:
-        map.revealed_areas = request.area
-    else:
-        map.revealed_areas = map.revealed_areas.union(request.area)
-
-    changes = {"$set": {"revealed_areas": shapely.geometry.mapping(map.revealed_areas)}}
-    database.maps.find_one_and_update(request.id, changes)
-    await map.broadcast_changes(changes)
+    area = await geometry.run_geometry(geometry.to_polygon, request.area)
+    require(not area.is_empty, "invalid area")
+    revision, chunks = await fog.edit_fog(map, area, reveal=True)
+    await map.pool.broadcast({"type": "fog", "revision": revision, "chunks": chunks})
+    return {"status": "success", "revision": revision}
 
 
 @router.post("/hide")
 async def map_hide(request: MapPolygonRequest):
-    map = require(database.maps.find_one(request.id), "invalid map id")
+    map = require(find_map(request.id), "invalid map id")
     if not request.requester.is_gm:
         auth_require(map.has_permission(request.requester.id, "reveal", Permissions.WRITE))
 
-    if map.revealed_areas is None:
-        return
+    area = await geometry.run_geometry(geometry.to_polygon, request.area)
+    require(not area.is_empty, "invalid area")
+    revision, chunks = await fog.edit_fog(map, area, reveal=False)
+    await map.pool.broadcast({"type": "fog", "revision": revision, "chunks": chunks})
+    return {"status": "success", "revision": revision}
+
+
+class MapViewportRequest(AuthRequest):
+    id: str
+    x: float
+    y: float
+    width: float
+    height: float
+    layers: Optional[list[Layer]] = None
 
-    map.revealed_areas = map.revealed_areas.difference(request.area)
 
-    changes = {"$set": {"revealed_areas": shapely.geometry.mapping(map.revealed_areas)}}
-    database.maps.find_one_and_update(request.id, changes)
-    await map.broadcast_changes(changes)
+@router.post("/viewport")
+async def map_viewport(request: MapViewportRequest):
+    """
+    Get the tokens of a map within a rectangle.
+    """
+    map = require(find_map(request.id), "invalid map id")
+    auth_require(request.requester.is_gm or map.has_permission(request.requester.id, "*", Permissions.READ))
+    require(request.width >= 0 and request.height >= 0, "invalid viewport")
+
+    area = (request.x, request.y, request.x + request.width, request.y + request.height)
+    tokens = find_tokens(map.id, spatial.get_index(map.id).query(area, request.layers))
+    return {"status": "success", "tokens": {token.id: token for token in tokens}}
+
+
+class MapTargetsRequest(AuthRequest):
+    id: str
+    # One of circle, cone or polygon
+    shape: str
+    # Center of a circle, or point of a cone
+    x: float = 0.0
+    y: float = 0.0
+    radius: float = 0.0
+    # Radians, the way tokens are rotated
+    direction: float = 0.0
+    # Full width of a cone, where the default makes it as wide as it is long
+    angle: float = 2 * math.atan(0.5)
+    # Outline of a polygon
+    points: list[tuple[float, float]] = Field(default_factory=list)
+    # Only characters are targeted unless told otherwise
+    layers: list[Layer] = Field(default_factory=lambda: [Layer.CHARACTERS])
+
+
+@router.post("/targets")
+async def map_targets(request: MapTargetsRequest):
+    """
+    Get the tokens on a map within an area of effect, and the characters
+    they are linked to.
+    """
+    map = require(find_map(request.id), "invalid map id")
+    auth_require(request.requester.is_gm or map.has_permission(request.requester.id, "*", Permissions.READ))
+
+    if request.shape == "circle":
+        require(request.radius > 0, "radius must be positive")
+        template = geometry.circle_template(request.x, request.y, request.radius)
+    elif request.shape == "cone":
+        require(request.radius > 0, "radius must be positive")
+        require(0 < request.angle <= 2 * math.pi, "invalid cone angle")
+        template = geometry.cone_template(request.x, request.y, request.radius, request.direction, request.angle)
+    elif request.shape == "polygon":
+        template = await geometry.run_geometry(geometry.to_polygon, request.points)
+        require(not template.is_empty, "invalid area")
+    else:
+        raise JsonError("invalid shape")
+
+    candidates = find_tokens(map.id, spatial.get_index(map.id).query(template.bounds, request.layers))
+    targets = await geometry.run_geometry(spatial.hit_tokens, template, candidates)
+    return {
+        "status": "success",
+        "tokens": {token.id: token for token in targets},
+        "character_ids": list(dict.fromkeys(token.character_id for token in targets if token.character_id)),
+    }
+
+
+@ws_handlers.register("viewport")
+def set_viewport(connection: Connection, request: dict):
+    """
+    Only forward token updates within a rectangle of a map to this
+    connection, or every update again if the viewport is null.
+    """
+    pool = request.get("pool")
+    viewport = request.get("viewport")
+    if not isinstance(pool, str):
+        raise JsonError("invalid pool")
+    if viewport is None:
+        connection.viewports.pop(pool, None)
+        return
+    try:
+        x, y = float(viewport["x"]), float(viewport["y"])
+        width, height = float(viewport["width"]), float(viewport["height"])
+    except (TypeError, KeyError, ValueError):
+        raise JsonError("invalid viewport")
+    if not (width >= 0 and height >= 0):
+        raise JsonError("invalid viewport")
+    connection.viewports[pool] = (x, y, x + width, y + height)
+
+
+@ws_handlers.register("move-token")
+def move_token(connection: Connection, request: dict):
+    """
+    Move a token while it is being dragged, which is broadcast and written
+    in batches rather than as a map update per move. Rejected moves are
+    dropped, since the token or map may have just been deleted and errors
+    would close the connection.
+    """
+    try:
+        movement.move_token(connection, request.get("pool"), request.get("token"), request.get("x"), request.get("y"))
+    except (AuthError, JsonError):
+        pass
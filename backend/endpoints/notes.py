@@ -1,6 +1,6 @@
 from fastapi import APIRouter
 
-from ..lib import database
+from ..lib import database, listings
 from ..lib.errors import JsonError
 from ..lib.utils import require, auth_require
 from ..models.database_models import Note, Permissions, get_pool
@@ -25,12 +25,15 @@ async def note_create(request: NoteCreateRequest):
         note.add_permission("*", "*", Permissions.READ)
         note.add_permission(request.requester.id, "*", Permissions.OWNER)
 
+    note.ancestors = []
     if note.folder_id is not None:
         folder = require(database.note_folders.find_one(note.folder_id), "invalid folder id")
         if not request.requester.is_gm:
             auth_require(folder.has_permission(request.requester.id, "*", Permissions.WRITE))
+        note.ancestors = folder.lineage
 
     note = database.notes.create(note.model_dump(exclude_defaults=True))
+    listings.invalidate_listing("note", note.folder_id)
 
     await get_pool("notes").broadcast({
         "type": "create",
@@ -51,6 +54,7 @@ async def note_delete(request: NoteDeleteRequest):
     if not request.requester.is_gm:
         auth_require(note.has_permission(request.requester.id, "*", Permissions.OWNER))
     database.notes.delete_one(note.id)
+    listings.invalidate_listing("note", note.folder_id)
     await note.pool.broadcast({
         "type": "delete",
     })
@@ -74,6 +78,7 @@ async def note_update(request: NoteUpdateRequest):
         auth_require(note.has_permission(request.requester.id, "*", Permissions.WRITE))
 
     database.notes.find_one_and_update(request.id, request.changes)
+    listings.invalidate_listing("note", note.folder_id)
 
     await note.broadcast_changes(request.changes)
 
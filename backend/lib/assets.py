@@ -0,0 +1,128 @@
+import os
+import re
+from bson import ObjectId
+from pathlib import Path
+from pymongo import UpdateMany
+
+from . import database
+from .files import file_extensions
+
+
+def _path_filter(path: str) -> dict:
+    # Match the path itself and anything below it if it's a directory
+    return {"$or": [
+        {"path": path},
+        {"path": {"$regex": "^" + re.escape(path.rstrip("/") + "/")}},
+    ]}
+
+
+def find_references(path: str) -> list[dict]:
+    """
+    Find the documents referencing the given path, or any path below it.
+    """
+    return [
+        {
+            "path": reference["path"],
+            "collection": reference["collection"],
+            "id": reference["document_id"].binary.hex(),
+            "field": reference["field"],
+        }
+        for reference in database.asset_references.find(_path_filter(path))
+    ]
+
+
+def move_references(src: str, dst: str) -> dict[tuple[str, str], dict[str, str]]:
+    """
+    Rewrite every reference to src, or to a path below it, to point at the
+    same location under dst. Returns the $set changes applied to each
+    document, keyed by (collection name, document id).
+    """
+    src = src.rstrip("/")
+    dst = dst.rstrip("/")
+
+    # Group identical rewrites so each becomes a single update_many
+    groups: dict[str, dict[tuple[str, str, str], list[ObjectId]]] = {}
+    changes: dict[tuple[str, str], dict[str, str]] = {}
+    for reference in database.asset_references.find(_path_filter(src)):
+        old_path = reference["path"]
+        new_path = dst + old_path[len(src):]
+        collection_groups = groups.setdefault(reference["collection"], {})
+        collection_groups.setdefault((reference["field"], old_path, new_path), []).append(reference["document_id"])
+        document_key = (reference["collection"], reference["document_id"].binary.hex())
+        changes.setdefault(document_key, {})[reference["field"]] = new_path
+
+    for collection_name, collection_groups in groups.items():
+        database.db[collection_name].bulk_write([
+            UpdateMany({"_id": {"$in": ids}, field: old_path}, {"$set": {field: new_path}})
+            for (field, old_path, new_path), ids in collection_groups.items()
+        ], ordered=False)
+
+    if groups:
+        database.asset_references.update_many({"path": src}, {"$set": {"path": dst}})
+        database.asset_references.update_many(
+            {"path": {"$regex": "^" + re.escape(src + "/")}},
+            [{"$set": {"path": {"$concat": [dst, {"$substrCP": ["$path", len(src), {"$strLenCP": "$path"}]}]}}}],
+        )
+
+    return changes
+
+
+def find_unreferenced(root: Path) -> tuple[list[tuple[str, int]], int]:
+    """
+    Walk the given directory for image files that no document references.
+    This blocks, so it should be run on a worker thread. Returns the
+    unreferenced files with their sizes, and their total size.
+    """
+    referenced = {
+        group["_id"]
+        for group in database.asset_references.aggregate([{"$group": {"_id": "$path"}}])
+    }
+
+    results = []
+    total_size = 0
+    for directory, _, filenames in os.walk(root):
+        for filename in filenames:
+            if not file_extensions.get(Path(filename).suffix.lower(), "").startswith("image/"):
+                continue
+            path = os.path.join(directory, filename)
+            if path in referenced:
+                continue
+            try:
+                size = os.stat(path).st_size
+            except OSError:
+                continue
+            results.append((path, size))
+            total_size += size
+
+    results.sort()
+    return results, total_size
+
+
+def rebuild_asset_index() -> int:
+    """
+    Rebuild asset_references from scratch for every collection that tracks
+    assets. Returns the number of references indexed.
+    """
+    database.asset_references.delete_many({})
+    count = 0
+    for collection in (database.abilities, database.characters, database.notes, database.maps, database.tokens):
+        references = []
+        for document in collection.collection.find({}, database.ASSET_PROJECTION):
+            references.extend(
+                {"path": path, "collection": collection.name, "document_id": document["_id"], "field": field}
+                for field, path in database.extract_asset_references(document)
+            )
+        if references:
+            database.asset_references.insert_many(references)
+        count += len(references)
+    return count
+
+
+def ensure_asset_index():
+    """
+    Build asset_references if it is empty, as it is when upgrading from
+    before it existed. Otherwise every file would look unreferenced.
+    """
+    if database.asset_references.find_one({}, {"_id": 1}) is None:
+        count = rebuild_asset_index()
+        print("Built the asset index -", count, "references")
@@ -0,0 +1,127 @@
+import heapq
+import secrets
+from bson import ObjectId
+from typing import Optional, Union
+
+from . import database
+from ..models.database_models import Combat, Combatant, ScheduledExpiry, broadcast_batch
+
+
+# Combat id -> the combat as last written. Every write to combats goes
+# through update_combat, so these are never behind the database.
+combat_cache: dict[str, Combat] = {}
+# Combat id -> heap of (round, turn, id, expiry) for what it has scheduled,
+# built from the combat's scheduled list the first time it is needed
+schedules: dict[str, list[tuple[int, int, str, ScheduledExpiry]]] = {}
+
+
+def get_combat(id: str) -> Optional[Combat]:
+    combat = combat_cache.get(id)
+    if combat is None:
+        if not ObjectId.is_valid(id):
+            return None
+        combat = database.combats.find_one(id)
+        if combat is not None:
+            combat_cache[combat.id] = combat
+    return combat
+
+
+def create_combat(document: dict) -> Combat:
+    # Turn updates match on turn_index, so it has to be stored from the start
+    combat = database.combats.create({"turn_index": 0, "round": 1, **document})
+    combat_cache[combat.id] = combat
+    return combat
+
+
+def update_combat(filter: Union[dict, str], update: dict) -> Optional[Combat]:
+    """
+    Update a combat, returning it as written or None if the filter didn't
+    match.
+    """
+    combat = database.combats.find_one_and_update(filter, update)
+    if combat is not None:
+        combat_cache[combat.id] = combat
+    return combat
+
+
+def turn_index_of(combat: Combat, combatants: list[Combatant]) -> int:
+    """
+    Get the index in a new list of combatants that keeps the turn with
+    whoever has it now. If they are gone, the turn stays at the same index.
+    """
+    if not combatants:
+        return 0
+    current = combat.current_combatant
+    if current is not None:
+        for index, combatant in enumerate(combatants):
+            if combatant.id == current.id:
+                return index
+    return combat.turn_index % len(combatants)
+
+
+def get_schedule(combat: Combat) -> list[tuple[int, int, str, ScheduledExpiry]]:
+    schedule = schedules.get(combat.id)
+    if schedule is None:
+        schedule = [(expiry.round, expiry.turn, expiry.id, expiry) for expiry in combat.scheduled]
+        heapq.heapify(schedule)
+        schedules[combat.id] = schedule
+    return schedule
+
+
+def schedule_expiry(combat: Combat, rounds: int, character_id: str, ability_id: str = None, effect_id: str = None) -> ScheduledExpiry:
+    """
+    Schedule a cooldown or effect to end a number of rounds from now, at the
+    start of the turn it is now.
+    """
+    turn = combat.turn_index % len(combat.combatants) if combat.combatants else 0
+    expiry = ScheduledExpiry(
+        id=secrets.token_hex(12),
+        round=combat.round + rounds,
+        turn=turn,
+        character_id=character_id,
+        ability_id=ability_id,
+        effect_id=effect_id,
+    )
+    schedule = get_schedule(combat)
+    update_combat(combat.id, {"$push": {"scheduled": expiry.model_dump()}})
+    heapq.heappush(schedule, (expiry.round, expiry.turn, expiry.id, expiry))
+    return expiry
+
+
+def pop_due(combat: Combat, everything: bool = False) -> list[ScheduledExpiry]:
+    """
+    Take what is scheduled to end by the combat's current round and turn,
+    or everything scheduled if the combat is over.
+    """
+    schedule = get_schedule(combat)
+    due = []
+    while schedule and (everything or schedule[0][:2] <= (combat.round, combat.turn_index)):
+        due.append(heapq.heappop(schedule)[3])
+    if due:
+        update_combat(combat.id, {"$pull": {"scheduled": {"id": {"$in": [expiry.id for expiry in due]}}}})
+    return due
+
+
+async def expire(expiries: list[ScheduledExpiry], messages: list[dict] = None):
+    """
+    End cooldowns and effects on their characters in one write, and
+    broadcast it along with any other messages as one batch.
+    """
+    updates: dict[str, dict] = {}
+    for expiry in expiries:
+        if not ObjectId.is_valid(expiry.character_id):
+            continue
+        unset = updates.setdefault(expiry.character_id, {"$unset": {}})["$unset"]
+        if expiry.ability_id is not None:
+            unset[f"cooldowns.{expiry.ability_id}"] = 1
+        if expiry.effect_id is not None:
+            unset[f"effect_map.{expiry.effect_id}"] = 1
+    database.characters.bulk_update(list(updates.items()))
+
+    messages = list(messages or [])
+    messages.extend(
+        {"type": "update", "changes": update, "pool": character_id}
+        for character_id, update in updates.items()
+    )
+    if messages:
+        await broadcast_batch(messages)
@@ -1,9 +1,13 @@
+import asyncio
+import os
 import pymongo
+import time
 from bson import ObjectId
+from dataclasses import asdict, dataclass
 from pydantic import BaseModel, ValidationError
-from pymongo import ReturnDocument
+from pymongo import ReplaceOne, ReturnDocument, UpdateOne
 from pymongo.collection import Collection
-from typing import Generic, List, Type, TypeVar, Union
+from typing import Any, Generic, List, Optional, Type, TypeVar, Union
 
 from ..models import database_models as models
 
@@ -11,6 +15,18 @@ from ..models import database_models as models
 M = TypeVar('M', bound=BaseModel)
 
 
+# Top level fields that can contain file paths
+ASSET_FIELDS = ("image", "src", "tokens", "ability_map", "item_map")
+ASSET_PROJECTION = {field: 1 for field in ASSET_FIELDS}
+
+# How updates to the hot fields of collections with write-behind are written:
+# "immediate" writes each one as it happens, and "deferred" merges them in
+# memory and writes them every WRITE_BEHIND_INTERVAL seconds, losing at most
+# that much on a crash
+WRITE_BEHIND_MODE = os.environ.get("WRITE_BEHIND_MODE", "immediate")
+WRITE_BEHIND_INTERVAL = float(os.environ.get("WRITE_BEHIND_INTERVAL", 1.0))
+
+
 def _jsonify_oid(obj: Union[dict, ObjectId, None]):
     if obj is None:
         return None
@@ -37,12 +53,305 @@ def _prepare_filter(obj: Union[dict, str, None]):
         return obj
 
 
+def extract_asset_references(document: dict) -> list[tuple[str, str]]:
+    """
+    Find the file paths referenced by a raw document, as (field, path) pairs
+    where field is the dotted path to the referencing value.
+    """
+    references = []
+    if image := document.get("image"):
+        references.append(("image", image))
+    if src := document.get("src"):
+        references.append(("src", src))
+    for ability_id, ability in (document.get("ability_map") or {}).items():
+        if image := ability.get("image"):
+            references.append((f"ability_map.{ability_id}.image", image))
+    for item_id, item in (document.get("item_map") or {}).items():
+        if image := item.get("image"):
+            references.append((f"item_map.{item_id}.image", image))
+    for token_id, token in (document.get("tokens") or {}).items():
+        if src := token.get("src"):
+            references.append((f"tokens.{token_id}.src", src))
+    return references
+
+
+def _touches_asset_key(key: str) -> bool:
+    parts = key.split(".")
+    if parts[0] in ("image", "src"):
+        return True
+    if parts[0] in ASSET_FIELDS:
+        # Setting a whole sub-document or its image/src, but not e.g. tokens.<id>.x
+        return len(parts) <= 2 or parts[2] in ("image", "src")
+    return False
+
+
+def touches_assets(update: Union[dict, list]) -> bool:
+    # Pipeline updates could touch anything
+    if isinstance(update, list):
+        return True
+    for operator, fields in update.items():
+        # Whole document replacement
+        if not operator.startswith("$"):
+            return True
+        if isinstance(fields, dict):
+            for key in fields:
+                if _touches_asset_key(key):
+                    return True
+    return False
+
+
+def backfill_ancestors(folders: Collection, entries: Collection):
+    """
+    Fill in the ancestors array of folders and foldered entries created
+    before it was tracked.
+    """
+    if folders.count_documents({"ancestors": {"$exists": False}}) != 0:
+        parents = {
+            folder["_id"].binary.hex(): folder.get("parent_id")
+            for folder in folders.find({}, {"parent_id": 1})
+        }
+        lineages: dict[str, list[str]] = {}
+
+        def get_lineage(folder_id: str) -> list[str]:
+            if folder_id not in lineages:
+                lineage = []
+                current_id = folder_id
+                # Stop at missing parents and any existing cycles
+                while current_id is not None and current_id in parents and current_id not in lineage:
+                    lineage.append(current_id)
+                    current_id = parents[current_id]
+                lineages[folder_id] = lineage[::-1]
+            return lineages[folder_id]
+
+        folders.bulk_write([
+            UpdateOne({"_id": ObjectId(folder_id)}, {"$set": {"ancestors": get_lineage(folder_id)[:-1]}})
+            for folder_id in parents
+        ])
+    else:
+        lineages = None
+
+    folder_ids = entries.distinct("folder_id", {"ancestors": {"$exists": False}, "folder_id": {"$ne": None}})
+    for folder_id in folder_ids:
+        if lineages is None:
+            folder = folders.find_one({"_id": ObjectId(folder_id)}, {"ancestors": 1})
+            lineage = folder["ancestors"] + [folder_id] if folder is not None else [folder_id]
+        else:
+            lineage = get_lineage(folder_id) or [folder_id]
+        entries.update_many(
+            {"folder_id": folder_id, "ancestors": {"$exists": False}},
+            {"$set": {"ancestors": lineage}},
+        )
+
+
+def migrate_map_tokens(maps: "DocumentCollection", tokens: "DocumentCollection"):
+    """
+    Move tokens embedded in map documents, from before tokens had their own
+    collection, into the tokens collection.
+    """
+    for map in maps.collection.find({"tokens": {"$exists": True}}, {"tokens": 1}):
+        map_id = map["_id"].binary.hex()
+        ids = []
+        operations = []
+        for token_id, token in (map["tokens"] or {}).items():
+            token = {key: value for key, value in token.items() if key != "id"}
+            token["map_id"] = map_id
+            ids.append(ObjectId(token_id) if ObjectId.is_valid(token_id) else ObjectId())
+            operations.append(ReplaceOne({"_id": ids[-1]}, token, upsert=True))
+        if operations:
+            tokens.collection.bulk_write(operations, ordered=False)
+            tokens.reindex_assets(ids)
+        maps.collection.update_one({"_id": map["_id"]}, {"$unset": {"tokens": ""}})
+        maps.reindex_assets([map["_id"]])
+
+
+def _set_path(document: dict, key: str, value: Any):
+    *parents, field = key.split(".")
+    for parent in parents:
+        child = document.get(parent)
+        if not isinstance(child, dict):
+            child = {}
+            document[parent] = child
+        document = child
+    document[field] = value
+
+
+@dataclass
+class WriteBehindMetrics:
+    # Updates held in memory rather than written
+    deferred_updates: int = 0
+    # Documents written by flushes, fewer than the updates merged into them
+    documents_written: int = 0
+    flushes: int = 0
+    last_flush_ms: float = 0.0
+    # How long the oldest change in a flush waited to be written
+    last_lag_ms: float = 0.0
+    max_lag_ms: float = 0.0
+
+
 class DocumentCollection(Generic[M]):
     def __init__(self, collection: Collection, model: Type[M]):
         self.collection = collection
         self.model = model
         self.name = collection.name
-        self.collection.create_index("name")
+        self.track_assets = False
+        self.hot_fields: frozenset[str] = frozenset()
+        # Document id -> $set changes not yet written
+        self.pending: dict[ObjectId, dict[str, Any]] = {}
+        # Document id -> when its oldest unwritten change was made
+        self.pending_since: dict[ObjectId, float] = {}
+        self.flush_task: Optional[asyncio.Task] = None
+        self.write_metrics = WriteBehindMetrics()
+        document_collections.append(self)
+
+    def track_asset_references(self):
+        """
+        Keep asset_references up to date with the file paths referenced by
+        documents in this collection.
+        """
+        self.track_assets = True
+
+    def enable_write_behind(self, *fields: str):
+        """
+        Hold $set updates to the given top level fields in memory and write
+        them in batches, see WRITE_BEHIND_MODE. Reads through this collection
+        see held changes, queries on these fields and direct access to the
+        underlying collection don't.
+        """
+        self.hot_fields = frozenset(fields)
+        write_behind_collections.append(self)
+
+    def update_deferred(self, filter: Union[dict, str], update: dict):
+        """
+        Apply an update by id, holding it in memory if it only sets hot
+        fields, or writing it straight away otherwise.
+        """
+        if not self.is_deferrable(filter, update):
+            self.find_one_and_update(filter, update)
+            return
+
+        id = ObjectId(filter)
+        changes = self.pending.get(id)
+        # Setting inside a field that is already being set as a whole can't
+        # be merged, so write what's held first
+        if changes is not None and any(
+            key.startswith(existing + ".")
+            for key in update["$set"]
+            for existing in changes
+        ):
+            self.flush()
+            changes = None
+        if changes is None:
+            changes = {}
+            self.pending[id] = changes
+            self.pending_since[id] = time.monotonic()
+        for key, value in update["$set"].items():
+            for existing in [existing for existing in changes if existing.startswith(key + ".")]:
+                del changes[existing]
+            changes[key] = value
+        self.write_metrics.deferred_updates += 1
+
+        if self.flush_task is None:
+            self.flush_task = asyncio.get_running_loop().create_task(self.delayed_flush())
+
+    def is_deferrable(self, filter: Union[dict, str], update: dict) -> bool:
+        if WRITE_BEHIND_MODE != "deferred" or not self.hot_fields:
+            return False
+        if not isinstance(filter, str) or not ObjectId.is_valid(filter):
+            return False
+        if update.keys() != {"$set"} or not isinstance(update["$set"], dict):
+            return False
+        if not all(key.split(".", 1)[0] in self.hot_fields for key in update["$set"]):
+            return False
+        # Flushes are scheduled on the event loop
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+        return True
+
+    async def delayed_flush(self):
+        await asyncio.sleep(WRITE_BEHIND_INTERVAL)
+        self.flush_task = None
+        self.flush()
+
+    def flush(self):
+        """
+        Write out every held change. Every other write flushes first, so
+        held changes are never written after a later change.
+        """
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        if not self.pending:
+            return
+
+        pending, self.pending = self.pending, {}
+        pending_since, self.pending_since = self.pending_since, {}
+        start = time.monotonic()
+        try:
+            self.collection.bulk_write([
+                UpdateOne({"_id": id}, {"$set": changes})
+                for id, changes in pending.items()
+            ], ordered=False)
+        except Exception:
+            self.restore_pending(pending, pending_since)
+            raise
+        end = time.monotonic()
+
+        metrics = self.write_metrics
+        metrics.flushes += 1
+        metrics.documents_written += len(pending)
+        metrics.last_flush_ms = (end - start) * 1000
+        metrics.last_lag_ms = (end - min(pending_since.values())) * 1000
+        metrics.max_lag_ms = max(metrics.max_lag_ms, metrics.last_lag_ms)
+
+    def restore_pending(self, pending: dict[ObjectId, dict], pending_since: dict[ObjectId, float]):
+        """
+        Hold changes again after writing them failed, and try again after
+        WRITE_BEHIND_INTERVAL. Changes held since take precedence.
+        """
+        for id, changes in pending.items():
+            self.pending[id] = {**changes, **self.pending.get(id, {})}
+            self.pending_since[id] = pending_since[id]
+        if self.flush_task is None:
+            try:
+                self.flush_task = asyncio.get_running_loop().create_task(self.delayed_flush())
+            except RuntimeError:
+                pass
+
+    def apply_pending(self, document: Optional[dict]) -> Optional[dict]:
+        if document is not None and self.pending:
+            changes = self.pending.get(document.get("_id"))
+            if changes is not None:
+                for key, value in changes.items():
+                    _set_path(document, key, value)
+        return document
+
+    def index_assets(self, document: dict):
+        asset_references.delete_many({"collection": self.name, "document_id": document["_id"]})
+        references = extract_asset_references(document)
+        if references:
+            asset_references.insert_many([
+                {"path": path, "collection": self.name, "document_id": document["_id"], "field": field}
+                for field, path in references
+            ])
+
+    def reindex_assets(self, ids: list[ObjectId]):
+        if not ids:
+            return
+        asset_references.delete_many({"collection": self.name, "document_id": {"$in": ids}})
+        references = []
+        for document in self.collection.find({"_id": {"$in": ids}}, ASSET_PROJECTION):
+            references.extend(
+                {"path": path, "collection": self.name, "document_id": document["_id"], "field": field}
+                for field, path in extract_asset_references(document)
+            )
+        if references:
+            asset_references.insert_many(references)
+
+    def unindex_assets(self, ids: list[ObjectId]):
+        if ids:
+            asset_references.delete_many({"collection": self.name, "document_id": {"$in": ids}})
 
     def create(self, obj):
         obj["id"] = self.insert_one(obj)
@@ -51,12 +360,14 @@ class DocumentCollection(Generic[M]):
     def pre_process_filter(self, filter: dict):
         return _prepare_filter(filter)
 
-    def post_process_result(self, document: dict) -> M:
+    def post_process_result(self, document: dict, model: Type[BaseModel] = None) -> M:
         if document is None:
             return None
+        if model is None:
+            model = self.model
 
         try:
-            return self.model.model_validate(_jsonify_oid(document))
+            return model.model_validate(_jsonify_oid(document))
         except ValidationError as exc:
             for error in exc.errors():
                 location = list(error['loc'])
@@ -75,72 +386,234 @@ class DocumentCollection(Generic[M]):
                 else:
                     del cursor[terminal]
 
-            return self.model.model_validate(_jsonify_oid(document))
+            return model.model_validate(_jsonify_oid(document))
 
 
     def create_index(self, *args, **kwargs):
         self.collection.create_index(*args, **kwargs)
 
-    def find_one(self, filter: Union[dict, str]) -> M:
+    def find_one(self, filter: Union[dict, str], projection: dict = None) -> M:
         if filter is None:
             return None
-        return self.post_process_result(self.collection.find_one(self.pre_process_filter(filter)))
+        return self.post_process_result(self.apply_pending(self.collection.find_one(self.pre_process_filter(filter), projection)))
 
     def find(self, filter: dict = None, *args, **kwargs) -> List[M]:
-        return [self.post_process_result(document) for document in self.collection.find(self.pre_process_filter(filter), *args, **kwargs)]
+        return [
+            self.post_process_result(self.apply_pending(document))
+            for document in self.collection.find(self.pre_process_filter(filter), *args, **kwargs)
+        ]
+
+    def find_projected(self, filter: dict, model: Type[BaseModel], *args, **kwargs) -> list:
+        """
+        Find documents, only loading the fields of the given model.
+        """
+        projection = {name: 1 for name in model.model_fields if name != "id"}
+        return [
+            self.post_process_result(self.apply_pending(document), model)
+            for document in self.collection.find(self.pre_process_filter(filter), projection, *args, **kwargs)
+        ]
 
     def delete_one(self, filter: dict = None, *args, **kwargs):
+        self.flush()
+        if self.track_assets:
+            document = self.collection.find_one_and_delete(self.pre_process_filter(filter), {"_id": 1}, *args, **kwargs)
+            if document is None:
+                return False
+            self.unindex_assets([document["_id"]])
+            return True
         return self.collection.delete_one(self.pre_process_filter(filter), *args, **kwargs).deleted_count != 0
 
     def delete_many(self, filter: dict = None, *args, **kwargs):
-        return self.collection.delete_many(self.pre_process_filter(filter), *args, **kwargs).deleted_count
+        self.flush()
+        filter = self.pre_process_filter(filter)
+        if self.track_assets:
+            ids = self.collection.distinct("_id", filter)
+            deleted_count = self.collection.delete_many(filter, *args, **kwargs).deleted_count
+            self.unindex_assets(ids)
+            return deleted_count
+        return self.collection.delete_many(filter, *args, **kwargs).deleted_count
 
     def find_one_and_update(self, filter: dict, update: dict, *args, **kwargs) -> M:
         if filter is None:
             return None
-        return self.post_process_result(
-            self.collection.find_one_and_update(
-                self.pre_process_filter(filter),
-                update,
-                *args,
-                return_document=ReturnDocument.AFTER,
-                **kwargs
-            )
+        self.flush()
+        document = self.collection.find_one_and_update(
+            self.pre_process_filter(filter),
+            update,
+            *args,
+            return_document=ReturnDocument.AFTER,
+            **kwargs
         )
+        if document is not None and self.track_assets and touches_assets(update):
+            self.index_assets(document)
+        return self.post_process_result(document)
+
+    def update_one(self, filter: Union[dict, str], update: dict) -> bool:
+        """
+        Update a document without reading it back, returning whether it
+        matched.
+        """
+        if filter is None:
+            return False
+        self.flush()
+        filter = self.pre_process_filter(filter)
+        if self.track_assets and touches_assets(update):
+            document = self.collection.find_one_and_update(filter, update, return_document=ReturnDocument.AFTER)
+            if document is not None:
+                self.index_assets(document)
+            return document is not None
+        return self.collection.update_one(filter, update).matched_count != 0
 
     def update_many(self, filter: dict, update: dict, *args, **kwargs) -> int:
-        return self.collection.update_many(self.pre_process_filter(filter), update, *args, **kwargs).matched_count
+        self.flush()
+        filter = self.pre_process_filter(filter)
+        if self.track_assets and touches_assets(update):
+            ids = self.collection.distinct("_id", filter)
+            matched_count = self.collection.update_many(filter, update, *args, **kwargs).matched_count
+            self.reindex_assets(ids)
+            return matched_count
+        return self.collection.update_many(filter, update, *args, **kwargs).matched_count
+
+    def bulk_update(self, updates: list[tuple[Union[dict, str], dict]]) -> int:
+        """
+        Apply (filter, update) pairs to one document each in a single bulk
+        write, returning how many documents matched.
+        """
+        if not updates:
+            return 0
+        self.flush()
+        updates = [(self.pre_process_filter(filter), update) for filter, update in updates]
+        matched_count = self.collection.bulk_write([
+            UpdateOne(filter, update)
+            for filter, update in updates
+        ], ordered=False).matched_count
+        if self.track_assets:
+            touched = [filter for filter, update in updates if touches_assets(update)]
+            if touched:
+                self.reindex_assets(self.collection.distinct("_id", {"$or": touched}))
+        return matched_count
 
     def upsert(self, filter: dict, update: dict, *args, **kwargs):
-        return _jsonify_oid(self.collection.update_one(self.pre_process_filter(filter), update, *args, **kwargs, upsert=True).upserted_id)
-
-    def insert_one(self, *args, **kwargs) -> str:
-        return _jsonify_oid(self.collection.insert_one(*args, **kwargs).inserted_id)
-
-    def insert_many(self, *args, **kwargs) -> List[str]:
-        return [_jsonify_oid(id) for id in self.collection.insert_many(*args, **kwargs).inserted_ids]
+        self.flush()
+        filter = self.pre_process_filter(filter)
+        result = self.collection.update_one(filter, update, *args, **kwargs, upsert=True)
+        if self.track_assets and touches_assets(update):
+            if result.upserted_id is not None:
+                self.reindex_assets([result.upserted_id])
+            else:
+                self.reindex_assets(self.collection.distinct("_id", filter))
+        return _jsonify_oid(result.upserted_id)
+
+    def insert_one(self, document: dict, *args, **kwargs) -> str:
+        inserted_id = self.collection.insert_one(document, *args, **kwargs).inserted_id
+        if self.track_assets:
+            self.index_assets({**document, "_id": inserted_id})
+        return _jsonify_oid(inserted_id)
+
+    def insert_many(self, documents: list[dict], *args, **kwargs) -> List[str]:
+        inserted_ids = self.collection.insert_many(documents, *args, **kwargs).inserted_ids
+        if self.track_assets:
+            self.reindex_assets(inserted_ids)
+        return [_jsonify_oid(id) for id in inserted_ids]
+
+
+# Every collection, to create indexes for at startup
+document_collections: list[DocumentCollection] = []
+# Collections holding hot fields in memory, to flush at shutdown
+write_behind_collections: list[DocumentCollection] = []
+
+
+def flush_write_behind():
+    for collection in write_behind_collections:
+        collection.flush()
+
+
+def get_write_behind_metrics() -> dict[str, dict]:
+    """
+    Write-behind metrics for each collection using it, keyed by name.
+    """
+    now = time.monotonic()
+    return {
+        collection.name: {
+            **asdict(collection.write_metrics),
+            "mode": WRITE_BEHIND_MODE,
+            "pending_documents": len(collection.pending),
+            "oldest_pending_ms": (now - min(collection.pending_since.values())) * 1000 if collection.pending_since else 0.0,
+        }
+        for collection in write_behind_collections
+    }
 
 
 # Mongo Client
 client = pymongo.MongoClient("mongodb://nonsense_db:27017")
 db = client.nonsense_db
 
+# Path -> referencing document index, maintained by collections that track assets
+asset_references = db.asset_references
+
 # Collections
 abilities = DocumentCollection(db.abilities, models.Ability)
-abilities.create_index("folder_id")
+abilities.track_asset_references()
 characters = DocumentCollection(db.characters, models.Character)
-characters.create_index("folder_id")
+characters.track_asset_references()
+# Changed many times a minute during combat
+characters.enable_write_behind("hp", "temp_hp", "actions", "reactions")
 notes = DocumentCollection(db.notes, models.Note)
-notes.create_index("folder_id")
+notes.track_asset_references()
 items = DocumentCollection(db.items, models.Item)
 users = DocumentCollection(db.users, models.User)
 combats = DocumentCollection(db.combats, models.Combat)
 maps = DocumentCollection(db.maps, models.Map)
+maps.track_asset_references()
+tokens = DocumentCollection(db.tokens, models.Token)
+tokens.track_asset_references()
 messages = DocumentCollection(db.messages, models.Message)
 ability_folders = DocumentCollection(db.ability_folders, models.Folder)
 character_folders = DocumentCollection(db.character_folders, models.Folder)
 note_folders = DocumentCollection(db.note_folders, models.Folder)
-
 sessions = DocumentCollection(db.sessions, models.Session)
-sessions.create_index("auth_token")
-sessions.create_index("last_auth_date", expireAfterSeconds=2592000)
+
+
+def initialize():
+    """
+    Create indexes and bring documents from older versions up to date. This
+    runs at startup rather than on import, as tile workers import the app
+    too.
+    """
+    asset_references.create_index("path")
+    asset_references.create_index([("collection", 1), ("document_id", 1)])
+
+    for collection in document_collections:
+        collection.create_index("name")
+    abilities.create_index("folder_id")
+    abilities.create_index([("folder_id", 1), ("name", 1), ("_id", 1)])
+    abilities.create_index("ancestors")
+    abilities.create_index([("permissions.$**", 1)])
+    characters.create_index("folder_id")
+    characters.create_index([("folder_id", 1), ("name", 1), ("_id", 1)])
+    characters.create_index("ancestors")
+    characters.create_index([("permissions.$**", 1)])
+    notes.create_index("folder_id")
+    notes.create_index([("folder_id", 1), ("name", 1), ("_id", 1)])
+    notes.create_index("ancestors")
+    notes.create_index([("permissions.$**", 1)])
+    combats.create_index("combatants.character_id")
+    maps.create_index([("permissions.$**", 1)])
+    tokens.create_index([("map_id", 1), ("layer", 1)])
+    tokens.create_index("character_id")
+    ability_folders.create_index("ancestors")
+    ability_folders.create_index([("permissions.$**", 1)])
+    character_folders.create_index("ancestors")
+    character_folders.create_index([("permissions.$**", 1)])
+    note_folders.create_index("ancestors")
+    note_folders.create_index([("permissions.$**", 1)])
+    sessions.create_index("auth_token")
+    sessions.create_index("last_auth_date", expireAfterSeconds=2592000)
+
+    # Combats from before turns were tracked by index start where they stand,
+    # their combatants having been rotated to put the current one first
+    combats.collection.update_many({"turn_index": {"$exists": False}}, {"$set": {"turn_index": 0, "round": 1}})
+    backfill_ancestors(db.ability_folders, db.abilities)
+    backfill_ancestors(db.character_folders, db.characters)
+    backfill_ancestors(db.note_folders, db.notes)
+    migrate_map_tokens(maps, tokens)
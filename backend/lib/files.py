@@ -1,6 +1,14 @@
+import asyncio
 import hashlib
+import heapq
+import json
+import math
+import multiprocessing
 import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import Callable, Optional
 from wand.image import Image
 from wand.color import Color
 
@@ -9,6 +17,17 @@ from ..models.database_models import User
 
 
 THUMBNAILS_DIR = Path("/thumbnails")
+METADATA_DIR = Path("/data/metadata")
+TILES_DIR = THUMBNAILS_DIR / "tiles"
+TILES_URL = "/thumbnails/tiles"
+DELETE_BATCH_SIZE = 256
+
+TILE_SIZE = 512
+TILE_QUALITY = 85
+# Images with a side longer than this are split into a tile pyramid
+TILE_THRESHOLD = 4096
+TILE_WORKERS = int(os.environ.get("TILE_WORKERS", 2))
+TILE_MEMORY_LIMIT = int(os.environ.get("TILE_MEMORY_LIMIT", 512 * 1024 * 1024))
 
 
 file_extensions = {
@@ -66,6 +85,9 @@ file_extensions = {
 }
 
 
+PROBED_TYPES = {"image/png", "image/jpeg", "image/webp", "image/gif", "image/bmp"}
+
+
 file_signatures = (
     # Images
     ([(0, b"RIFF"), (8, b"WEBP")], "image/webp"),
@@ -160,8 +182,201 @@ def sniff(path: Path):
         return "binary"
 
 
+def _probe_jpeg(fd: int) -> Optional[tuple[int, int]]:
+    # Walk the segment headers until a start of frame marker is found
+    offset = 2
+    while True:
+        segment = os.pread(fd, 9, offset)
+        if len(segment) < 4 or segment[0] != 0xFF:
+            return None
+        marker = segment[1]
+        if marker == 0xFF:
+            # Fill byte
+            offset += 1
+        elif marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            # Standalone marker without a length
+            offset += 2
+        elif marker in (0xD9, 0xDA):
+            # End of image or start of scan before any frame header
+            return None
+        elif 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            if len(segment) < 9:
+                return None
+            height = int.from_bytes(segment[5:7], "big")
+            width = int.from_bytes(segment[7:9], "big")
+            return width, height
+        else:
+            offset += 2 + int.from_bytes(segment[2:4], "big")
+
+
+def probe_dimensions(path: Path) -> Optional[tuple[int, int]]:
+    """
+    Read the pixel dimensions of a PNG, JPEG, WebP, GIF or BMP image from its
+    header, without decoding it. Returns None for any other kind of file, or
+    one too short to hold the header it starts.
+    """
+    fd = os.open(str(path), os.O_RDONLY)
+    try:
+        data = os.read(fd, 64)
+        if data.startswith(b"\x89PNG\r\n\x1a\n") and data[12:16] == b"IHDR" and len(data) >= 24:
+            return int.from_bytes(data[16:20], "big"), int.from_bytes(data[20:24], "big")
+        elif data[:6] in (b"GIF87a", b"GIF89a") and len(data) >= 10:
+            return int.from_bytes(data[6:8], "little"), int.from_bytes(data[8:10], "little")
+        elif data.startswith(b"BM") and len(data) >= 26:
+            if int.from_bytes(data[14:18], "little") == 12:
+                # OS/2 BITMAPCOREHEADER
+                return int.from_bytes(data[18:20], "little"), int.from_bytes(data[20:22], "little")
+            width = int.from_bytes(data[18:22], "little", signed=True)
+            height = int.from_bytes(data[22:26], "little", signed=True)
+            return abs(width), abs(height)
+        elif data[0:4] == b"RIFF" and data[8:12] == b"WEBP":
+            chunk = data[12:16]
+            if chunk == b"VP8 " and data[23:26] == b"\x9d\x01\x2a" and len(data) >= 30:
+                return (
+                    int.from_bytes(data[26:28], "little") & 0x3FFF,
+                    int.from_bytes(data[28:30], "little") & 0x3FFF,
+                )
+            elif chunk == b"VP8L" and data[20:21] == b"\x2f" and len(data) >= 25:
+                bits = int.from_bytes(data[21:25], "little")
+                return 1 + (bits & 0x3FFF), 1 + ((bits >> 14) & 0x3FFF)
+            elif chunk == b"VP8X" and len(data) >= 30:
+                return 1 + int.from_bytes(data[24:27], "little"), 1 + int.from_bytes(data[27:30], "little")
+            return None
+        elif data.startswith(b"\xff\xd8"):
+            return _probe_jpeg(fd)
+        else:
+            return None
+    except (IndexError, ValueError):
+        # Anything malformed past the checks above is treated as unknown
+        return None
+    finally:
+        os.close(fd)
+
+
+def get_metadata_path(directory: Path) -> Path:
+    return METADATA_DIR / (hashlib.sha256(bytes(directory)).hexdigest() + ".json")
+
+
+def load_directory_metadata(directory: Path) -> dict:
+    try:
+        with open(get_metadata_path(directory)) as fp:
+            return json.load(fp)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_directory_metadata(directory: Path, metadata: dict):
+    metadata_path = get_metadata_path(directory)
+    metadata_path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = metadata_path.with_suffix(".tmp")
+    with open(temporary_path, "w") as fp:
+        json.dump(metadata, fp)
+    os.replace(temporary_path, metadata_path)
+
+
+def delete_directory_metadata(directory: Path):
+    get_metadata_path(directory).unlink(missing_ok=True)
+
+
+def get_dimensions(image_paths: list[Path]) -> dict[Path, Optional[tuple[int, int]]]:
+    """
+    Get the pixel dimensions of the given images, probing only the files that
+    changed since they were last cached in their directory's metadata.
+    """
+    by_directory: dict[Path, list[Path]] = {}
+    for image_path in image_paths:
+        by_directory.setdefault(image_path.parent, []).append(image_path)
+
+    results = {}
+    for directory, paths in by_directory.items():
+        metadata = load_directory_metadata(directory)
+        modified = False
+        for path in paths:
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            cached = metadata.get(path.name)
+            if cached is not None and cached["mtime"] == stat.st_mtime_ns and cached["size"] == stat.st_size:
+                dimensions = cached["dimensions"]
+            else:
+                try:
+                    dimensions = probe_dimensions(path)
+                except OSError:
+                    dimensions = None
+                metadata[path.name] = {
+                    "mtime": stat.st_mtime_ns,
+                    "size": stat.st_size,
+                    "dimensions": dimensions,
+                }
+                modified = True
+            results[path] = dimensions
+        if modified:
+            save_directory_metadata(directory, metadata)
+    return results
+
+
+def _entry_key(entry: os.DirEntry) -> tuple[int, str]:
+    try:
+        is_dir = entry.is_dir()
+    except OSError:
+        is_dir = False
+    return (0 if is_dir else 1, entry.name)
+
+
+def encode_cursor(key: tuple[int, str]) -> str:
+    return f"{key[0]}/{key[1]}"
+
+
+def decode_cursor(cursor: str) -> tuple[int, str]:
+    kind, _, name = cursor.partition("/")
+    if kind not in ("0", "1") or not name:
+        raise JsonError("invalid cursor")
+    return (int(kind), name)
+
+
+def scan_directory(
+    path: Path,
+    prefix: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: Optional[int] = None,
+) -> tuple[list[tuple[bool, os.DirEntry]], Optional[str]]:
+    """
+    List a directory ordered directories first, then by name, without sniffing
+    any of its entries. Returns a page of (is_dir, entry) pairs starting after
+    the given cursor, and the cursor of the next page (None on the last page).
+    """
+    after_key = decode_cursor(after) if after else None
+    with os.scandir(path) as iterator:
+        candidates = []
+        for entry in iterator:
+            if prefix and not entry.name.startswith(prefix):
+                continue
+            key = _entry_key(entry)
+            if after_key is not None and key <= after_key:
+                continue
+            candidates.append((key, entry))
+
+    if limit is None:
+        page = sorted(candidates, key=lambda candidate: candidate[0])
+        next_cursor = None
+    else:
+        page = heapq.nsmallest(limit + 1, candidates, key=lambda candidate: candidate[0])
+        if len(page) > limit:
+            page = page[:limit]
+            next_cursor = encode_cursor(page[-1][0])
+        else:
+            next_cursor = None
+
+    return [(key[0] == 0, entry) for key, entry in page], next_cursor
+
+
+def get_thumbnail_path(image_path: Path) -> Path:
+    return THUMBNAILS_DIR / (hashlib.sha256(bytes(image_path)).hexdigest() + ".png")
+
+
 def generate_thumbnail(image_path: Path, force: bool = False, svg: bool = False):
-    thumbnail_path = THUMBNAILS_DIR / (hashlib.sha256(bytes(image_path)).hexdigest() + ".png")
+    thumbnail_path = get_thumbnail_path(image_path)
     if not force and thumbnail_path.exists():
         return
 
@@ -177,9 +392,200 @@ def generate_thumbnail(image_path: Path, force: bool = False, svg: bool = False)
 
 
 def delete_thumbnail(image_path: Path):
-    thumbnail_path = THUMBNAILS_DIR / (hashlib.sha256(bytes(image_path)).hexdigest() + ".png")
-    thumbnail_path.unlink(missing_ok=True)
+    get_thumbnail_path(image_path).unlink(missing_ok=True)
+    shutil.rmtree(get_tiles_path(image_path), ignore_errors=True)
+
+
+def delete_thumbnails(image_paths: list[Path]):
+    thumbnail_paths = [get_thumbnail_path(image_path) for image_path in image_paths]
+    for thumbnail_path in thumbnail_paths:
+        thumbnail_path.unlink(missing_ok=True)
+    tiles_paths = [get_tiles_path(image_path) for image_path in image_paths]
+    for tiles_path in tiles_paths:
+        shutil.rmtree(tiles_path, ignore_errors=True)
+
+
+def get_tiles_path(image_path: Path) -> Path:
+    return TILES_DIR / hashlib.sha256(bytes(image_path)).hexdigest()
+
+
+def load_tile_manifest(image_path: Path) -> Optional[dict]:
+    """
+    Get the tile manifest for an image, or None if the image has no tiles
+    or has changed since they were generated.
+    """
+    try:
+        with open(get_tiles_path(image_path) / "manifest.json") as fp:
+            manifest = json.load(fp)
+        stat = image_path.stat()
+    except (OSError, ValueError):
+        return None
+    if manifest["source"] != {"mtime": stat.st_mtime_ns, "size": stat.st_size}:
+        return None
+    return manifest
+
+
+def generate_tiles(image_path: Path, force: bool = False) -> dict:
+    """
+    Split an image into a pyramid of WebP tiles. Level 0 is full resolution
+    and each following level halves the previous one, down to a level that
+    fits in a single tile. Returns the manifest describing the pyramid.
+    """
+    if not force and (manifest := load_tile_manifest(image_path)) is not None:
+        return manifest
+
+    stat = image_path.stat()
+    tiles_path = get_tiles_path(image_path)
+    shutil.rmtree(tiles_path, ignore_errors=True)
+
+    levels = []
+    with Image(filename=str(image_path)) as image:
+        width, height = image.width, image.height
+        with image.clone() as current:
+            while True:
+                columns = math.ceil(current.width / TILE_SIZE)
+                rows = math.ceil(current.height / TILE_SIZE)
+                level_path = tiles_path / str(len(levels))
+                level_path.mkdir(parents=True, exist_ok=True)
+                for row in range(rows):
+                    for column in range(columns):
+                        left = column * TILE_SIZE
+                        top = row * TILE_SIZE
+                        right = min(left + TILE_SIZE, current.width)
+                        bottom = min(top + TILE_SIZE, current.height)
+                        with current[left:right, top:bottom] as tile:
+                            tile.format = "webp"
+                            tile.compression_quality = TILE_QUALITY
+                            tile.save(filename=str(level_path / f"{column}_{row}.webp"))
+                levels.append({
+                    "scale": current.width / width,
+                    "width": current.width,
+                    "height": current.height,
+                    "columns": columns,
+                    "rows": rows,
+                })
+                if columns == 1 and rows == 1:
+                    break
+                current.resize(max(1, current.width // 2), max(1, current.height // 2))
+
+    manifest = {
+        "url": f"{TILES_URL}/{tiles_path.name}",
+        "format": "webp",
+        "tile_size": TILE_SIZE,
+        "width": width,
+        "height": height,
+        "levels": levels,
+        "source": {"mtime": stat.st_mtime_ns, "size": stat.st_size},
+    }
+    temporary_path = tiles_path / "manifest.tmp"
+    with open(temporary_path, "w") as fp:
+        json.dump(manifest, fp)
+    os.replace(temporary_path, tiles_path / "manifest.json")
+    return manifest
+
+
+def needs_tiles(image_path: Path) -> bool:
+    try:
+        dimensions = get_dimensions([image_path]).get(image_path)
+    except OSError:
+        return False
+    return dimensions is not None and max(dimensions) > TILE_THRESHOLD
+
+
+def _init_tile_worker():
+    # Keep ImageMagick within budget, spilling to disk past the memory limit
+    from wand.resource import limits
+    limits["memory"] = TILE_MEMORY_LIMIT
+    limits["map"] = TILE_MEMORY_LIMIT * 2
+    limits["thread"] = 1
+
+
+_tile_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_tile_pool() -> ProcessPoolExecutor:
+    global _tile_pool
+    if _tile_pool is None:
+        _tile_pool = ProcessPoolExecutor(
+            max_workers=TILE_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_tile_worker,
+        )
+    return _tile_pool
+
+
+async def generate_tiles_async(image_path: Path, force: bool = False) -> dict:
+    return await asyncio.get_running_loop().run_in_executor(get_tile_pool(), generate_tiles, image_path, force)
+
+
+def delete_tree(path: Path, progress: Callable[[int], None] = None, batch_size: int = DELETE_BATCH_SIZE) -> int:
+    """
+    Delete a file or an entire directory tree, removing the thumbnails of
+    deleted files in batches. This blocks, so it should be run on a worker
+    thread. The progress callback is given the running count of deleted files
+    after each batch. Returns the total number of deleted files.
+    """
+    if path.is_symlink() or not path.is_dir():
+        path.unlink()
+        delete_thumbnail(path)
+        return 1
+
+    deleted = 0
+    pending: list[Path] = []
+    directories: list[str] = []
+    stack: list[str] = [str(path)]
+    while stack:
+        directory = stack.pop()
+        directories.append(directory)
+        with os.scandir(directory) as iterator:
+            for entry in iterator:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    continue
+                os.unlink(entry.path)
+                pending.append(Path(entry.path))
+                if len(pending) >= batch_size:
+                    delete_thumbnails(pending)
+                    deleted += len(pending)
+                    pending = []
+                    if progress is not None:
+                        progress(deleted)
+
+    if pending:
+        delete_thumbnails(pending)
+        deleted += len(pending)
+        if progress is not None:
+            progress(deleted)
+
+    # Children were visited after their parents, so remove them first
+    for directory in reversed(directories):
+        os.rmdir(directory)
+        delete_directory_metadata(Path(directory))
+
+    return deleted
+
+
+def get_listing_dimensions(user_root: Path, results: list[tuple[str, str]]) -> dict[str, tuple[int, int]]:
+    image_paths = [
+        user_root / file_path.lstrip("/")
+        for file_type, file_path in results
+        if file_type in PROBED_TYPES
+    ]
+    return {
+        "/" + str(image_path.relative_to(user_root)): dimensions
+        for image_path, dimensions in get_dimensions(image_paths).items()
+        if dimensions is not None
+    }
+
 
+def generate_thumbnails(user_root: Path, results: list[tuple[str, str]]):
+    for file_type, file_path in results:
+        if file_type == "image/gif":
+            pass # Don't thumbnail GIFs
+        elif file_type == "image/svg":
+            generate_thumbnail(user_root / file_path.lstrip("/"), svg=True)
+        elif file_type.startswith("image/"):
+            generate_thumbnail(user_root / file_path.lstrip("/"))
 
 
 def validate_path(requester: User, path: str) -> Path:
@@ -0,0 +1,212 @@
+import asyncio
+import json
+import shapely
+import time
+from bson import ObjectId
+from dataclasses import asdict, dataclass, field
+from typing import Optional
+
+from . import database, geometry
+from .errors import JsonError
+from ..models.database_models import Map, get_pool
+
+
+# Seconds between an edit and writing the revealed areas back to the map
+FOG_WRITE_DELAY = 2.0
+# Seconds the live revealed areas of a map nobody is subscribed to are kept
+# after they were last used
+FOG_EVICT_DELAY = 60.0
+
+
+@dataclass
+class FogMetrics:
+    """
+    The size of a map's revealed areas at its last write.
+    """
+    vertices_before: int = 0
+    vertices_after: int = 0
+    geojson_bytes: int = 0
+    wkb_bytes: int = 0
+    simplify_ms: float = 0.0
+
+
+@dataclass
+class FogState:
+    map_id: str
+    revealed: shapely.geometry.base.BaseGeometry
+    revision: int
+    flush_task: Optional[asyncio.Task] = field(default=None, repr=False)
+    # Held while the revealed areas are being worked on in the geometry pool,
+    # so edits to one map apply in order
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock, repr=False)
+    metrics: FogMetrics = field(default_factory=FogMetrics)
+    last_used: float = field(default_factory=time.monotonic)
+
+
+fog_states: dict[str, FogState] = {}
+# How many times any map's live revealed areas have been forgotten, to tell
+# when one may have been forgotten while it was being loaded
+generation = 0
+
+
+async def get_fog(map: Map) -> FogState:
+    """
+    Get the live revealed areas of a map, which are ahead of the map document
+    while a write is pending. Maps are loaded without their revealed areas,
+    which are read here and decoded in the geometry pool.
+    """
+    while True:
+        state = fog_states.get(map.id)
+        if state is not None:
+            state.last_used = time.monotonic()
+            return state
+
+        loading_generation = generation
+        document = database.maps.collection.find_one(
+            {"_id": ObjectId(map.id)},
+            {"revealed_areas": 1, "reveal_revision": 1},
+        )
+        if document is None:
+            raise JsonError("invalid map id")
+        revealed = await geometry.run_geometry(geometry.load_revealed, document.get("revealed_areas"))
+
+        # Loaded by someone else meanwhile, or possibly edited directly and
+        # forgotten
+        if map.id in fog_states or generation != loading_generation:
+            continue
+        evict_idle()
+        state = FogState(map.id, revealed, document.get("reveal_revision", 0))
+        fog_states[map.id] = state
+        return state
+
+
+def evict_idle():
+    """
+    Drop the live revealed areas of maps nobody is subscribed to that have
+    been written and not used for FOG_EVICT_DELAY, so only maps in use are
+    kept in memory. They are loaded from the map again when next needed.
+    """
+    now = time.monotonic()
+    for map_id, state in list(fog_states.items()):
+        if state.flush_task is not None or state.lock.locked() or now - state.last_used < FOG_EVICT_DELAY:
+            continue
+        if not get_pool(map_id).connections:
+            del fog_states[map_id]
+
+
+def apply_edit(revealed: shapely.geometry.base.BaseGeometry, area: shapely.geometry.base.BaseGeometry, reveal: bool) -> tuple[shapely.geometry.base.BaseGeometry, dict[str, Optional[dict]]]:
+    if reveal:
+        revealed = geometry.reveal(revealed, area)
+    else:
+        revealed = geometry.hide(revealed, area)
+    return revealed, geometry.get_chunks(revealed, geometry.chunk_keys(area.bounds))
+
+
+async def edit_fog(map: Map, area: shapely.geometry.base.BaseGeometry, reveal: bool) -> tuple[int, dict[str, Optional[dict]]]:
+    """
+    Reveal or hide an area of the map. Returns the new revision and the
+    chunks that changed.
+    """
+    state = await get_fog(map)
+    async with state.lock:
+        state.revealed, chunks = await geometry.run_geometry(apply_edit, state.revealed, area, reveal)
+        state.revision += 1
+    schedule_flush(state)
+    return state.revision, chunks
+
+
+async def get_fog_chunks(map: Map) -> tuple[int, dict[str, Optional[dict]]]:
+    """
+    Get the revision of a map's revealed areas and every chunk with
+    something revealed.
+    """
+    state = await get_fog(map)
+    async with state.lock:
+        return state.revision, await geometry.run_geometry(geometry.get_chunks, state.revealed)
+
+
+def schedule_flush(state: FogState):
+    if state.flush_task is None:
+        state.flush_task = asyncio.create_task(delayed_flush(state))
+
+
+async def delayed_flush(state: FogState):
+    await asyncio.sleep(FOG_WRITE_DELAY)
+    state.flush_task = None
+    await flush(state)
+
+
+def prepare_flush(state: FogState) -> bytes:
+    """
+    Simplify a copy of the revealed areas and snap it to the grid for
+    writing, since unions and differences leave vertices where edges cross.
+    The live revealed areas are left as they are: edits to snapped geometry
+    are much slower, and clients already have the unsimplified chunks. The
+    written copy is only seen once the map is loaded again.
+    """
+    start = time.perf_counter()
+    state.metrics.vertices_before = int(shapely.get_num_coordinates(state.revealed))
+    written = shapely.set_precision(geometry.simplify(state.revealed), geometry.FOG_GRID_SIZE)
+    state.metrics.vertices_after = int(shapely.get_num_coordinates(written))
+    state.metrics.simplify_ms = (time.perf_counter() - start) * 1000
+
+    wkb = shapely.to_wkb(written)
+    state.metrics.wkb_bytes = len(wkb)
+    state.metrics.geojson_bytes = len(json.dumps(shapely.geometry.mapping(written)))
+    return wkb
+
+
+async def flush(state: FogState):
+    async with state.lock:
+        # Forgotten while waiting, the map document has been replaced
+        if fog_states.get(state.map_id) is not state:
+            return
+        wkb = await geometry.run_geometry(prepare_flush, state)
+        # Unless the map was edited directly while this was being prepared,
+        # which moves its revision past any of this state's
+        database.maps.update_one({"id": state.map_id, "reveal_revision": {"$not": {"$gt": state.revision}}}, {"$set": {
+            "revealed_areas": wkb,
+            "reveal_revision": state.revision,
+        }})
+    evict_idle()
+
+
+async def flush_all():
+    """
+    Write out every pending edit, for shutdown.
+    """
+    for state in list(fog_states.values()):
+        if state.flush_task is not None:
+            state.flush_task.cancel()
+            state.flush_task = None
+            await flush(state)
+
+
+def next_revision(map: Map) -> int:
+    """
+    Get a revision above any a map's revealed areas have had, live or
+    written, for a direct edit that replaces them. Clients ignore fog
+    revisions they are already past.
+    """
+    state = fog_states.get(map.id)
+    return max(map.reveal_revision, state.revision if state is not None else 0) + 1
+
+
+def forget_fog(map_id: str):
+    """
+    Drop the live revealed areas of a map without writing them, for when
+    the map document is changed or deleted directly.
+    """
+    global generation
+    generation += 1
+    state = fog_states.pop(map_id, None)
+    if state is not None and state.flush_task is not None:
+        state.flush_task.cancel()
+
+
+def get_metrics() -> dict[str, dict]:
+    """
+    The size of each loaded map's revealed areas at its last write, keyed by
+    map id.
+    """
+    return {map_id: asdict(state.metrics) for map_id, state in fog_states.items()}
@@ -0,0 +1,137 @@
+import asyncio
+import math
+import os
+import shapely
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar, Union
+
+
+# Revealed areas are sent to clients in square chunks of this many map
+# units, so an edit only resends the chunks it touched
+FOG_CHUNK_SIZE = 1024
+# Revealed areas are snapped to a grid of this many map units
+FOG_GRID_SIZE = 1.0
+# Distance in map units vertices can move by when simplifying revealed areas
+FOG_SIMPLIFY_TOLERANCE = 2.0
+# Threads running geometry operations, which release the GIL while in GEOS
+GEOMETRY_WORKERS = int(os.environ.get("GEOMETRY_WORKERS", 4))
+
+
+T = TypeVar("T")
+
+
+_geometry_pool: Optional[ThreadPoolExecutor] = None
+
+
+def get_geometry_pool() -> ThreadPoolExecutor:
+    global _geometry_pool
+    if _geometry_pool is None:
+        _geometry_pool = ThreadPoolExecutor(max_workers=GEOMETRY_WORKERS, thread_name_prefix="geometry")
+    return _geometry_pool
+
+
+async def run_geometry(func: Callable[..., T], *args) -> T:
+    """
+    Run a geometry operation on a worker thread, so large overlays don't
+    stall the event loop.
+    """
+    return await asyncio.get_running_loop().run_in_executor(get_geometry_pool(), func, *args)
+
+
+def to_polygon(coordinates: list[tuple[float, float]]) -> shapely.geometry.base.BaseGeometry:
+    """
+    Build an edit from the outline the client drew. Outlines that cross
+    themselves are split into the areas they enclose, and degenerate
+    outlines come out empty.
+    """
+    if len(coordinates) < 3:
+        return shapely.Polygon()
+    polygon = shapely.Polygon(coordinates)
+    if polygon.is_valid:
+        return polygon
+    parts = [part for part in shapely.get_parts(shapely.make_valid(polygon)) if shapely.get_dimensions(part) == 2]
+    return shapely.union_all(parts) if parts else shapely.Polygon()
+
+
+def circle_template(x: float, y: float, radius: float) -> shapely.Polygon:
+    return shapely.Point(x, y).buffer(radius)
+
+
+def cone_template(x: float, y: float, radius: float, direction: float, angle: float) -> shapely.Polygon:
+    """
+    A sector of a circle from its center, facing the direction and spanning
+    the angle, both in radians.
+    """
+    segments = max(2, math.ceil(angle / (math.pi / 32)))
+    start = direction - angle / 2
+    arc = [
+        (x + radius * math.cos(start + angle * i / segments), y + radius * math.sin(start + angle * i / segments))
+        for i in range(segments + 1)
+    ]
+    return shapely.Polygon([(x, y), *arc])
+
+
+def load_revealed(stored: Union[bytes, dict, None]) -> shapely.geometry.base.BaseGeometry:
+    """
+    Decode revealed areas as stored on a map: WKB, GeoJSON from before they
+    were WKB, or nothing revealed yet.
+    """
+    if stored is None:
+        return shapely.Polygon()
+    if isinstance(stored, dict):
+        return shapely.geometry.shape(stored)
+    return shapely.from_wkb(stored)
+
+
+def snap(area: shapely.geometry.base.BaseGeometry) -> shapely.geometry.base.BaseGeometry:
+    """
+    Snap an edit to the grid before applying it. Snapping each edit rather
+    than the accumulated result keeps the overlay operations fast.
+    """
+    return shapely.set_precision(area, FOG_GRID_SIZE)
+
+
+def reveal(revealed: shapely.geometry.base.BaseGeometry, area: shapely.geometry.base.BaseGeometry) -> shapely.geometry.base.BaseGeometry:
+    return revealed.union(snap(area))
+
+
+def hide(revealed: shapely.geometry.base.BaseGeometry, area: shapely.geometry.base.BaseGeometry) -> shapely.geometry.base.BaseGeometry:
+    return revealed.difference(snap(area))
+
+
+def simplify(revealed: shapely.geometry.base.BaseGeometry) -> shapely.geometry.base.BaseGeometry:
+    """
+    Drop the vertices that unions of many overlapping edits accumulate, such
+    as those along nearly straight edges, keeping the shape within tolerance.
+    Edges of snapped areas cross between grid points, so the result isn't on
+    the grid either, see fog.prepare_flush.
+    """
+    return shapely.simplify(revealed, FOG_SIMPLIFY_TOLERANCE, preserve_topology=True)
+
+
+def chunk_keys(bounds: tuple[float, float, float, float]) -> list[tuple[int, int]]:
+    min_x, min_y, max_x, max_y = bounds
+    return [
+        (x, y)
+        for x in range(math.floor(min_x / FOG_CHUNK_SIZE), math.floor(max_x / FOG_CHUNK_SIZE) + 1)
+        for y in range(math.floor(min_y / FOG_CHUNK_SIZE), math.floor(max_y / FOG_CHUNK_SIZE) + 1)
+    ]
+
+
+def get_chunks(geometry: shapely.geometry.base.BaseGeometry, keys: list[tuple[int, int]] = None) -> dict[str, Optional[dict]]:
+    """
+    Cut the geometry into the given chunks, where those with nothing
+    revealed are None, or into every chunk with something revealed.
+    """
+    everything = keys is None
+    if everything:
+        keys = chunk_keys(geometry.bounds) if not geometry.is_empty else []
+    chunks = {}
+    for x, y in keys:
+        box = shapely.box(x * FOG_CHUNK_SIZE, y * FOG_CHUNK_SIZE, (x + 1) * FOG_CHUNK_SIZE, (y + 1) * FOG_CHUNK_SIZE)
+        piece = geometry.intersection(box)
+        if not piece.is_empty:
+            chunks[f"{x},{y}"] = shapely.geometry.mapping(piece)
+        elif not everything:
+            chunks[f"{x},{y}"] = None
+    return chunks
@@ -0,0 +1,72 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+from ..models.database_models import EntrySummary, FolderSummary
+
+
+MAX_LISTINGS = 256
+
+# The entry type listed from each collection
+entry_types = {
+    "characters": "character",
+    "abilities": "ability",
+    "notes": "note",
+}
+
+
+@dataclass
+class Listing:
+    """
+    Everything in a folder, regardless of who is asking. Requesters who
+    aren't GMs get this filtered by their permissions.
+    """
+    id: Optional[str]
+    name: str
+    parent_id: Optional[str]
+    subfolders: list[FolderSummary]
+    entries: list[EntrySummary]
+
+
+# (entry type, folder id) -> listing, least recently used first
+_listings: OrderedDict[tuple[str, Optional[str]], Listing] = OrderedDict()
+# (entry type, alternate id) -> folder id
+_aliases: dict[tuple[str, str], str] = {}
+
+
+def get_listing(entry_type: str, folder_id: Optional[str]) -> Optional[Listing]:
+    key = (entry_type, _aliases.get((entry_type, folder_id), folder_id))
+    listing = _listings.get(key)
+    if listing is not None:
+        _listings.move_to_end(key)
+    return listing
+
+
+def store_listing(entry_type: str, folder_id: Optional[str], listing: Listing):
+    # Cached listings are checked against every requester who lists them
+    for summary in (*listing.subfolders, *listing.entries):
+        summary.memoize_permissions()
+    if folder_id != listing.id:
+        _aliases[(entry_type, folder_id)] = listing.id
+    _listings[(entry_type, listing.id)] = listing
+    _listings.move_to_end((entry_type, listing.id))
+    while len(_listings) > MAX_LISTINGS:
+        _listings.popitem(last=False)
+
+
+def invalidate_listing(entry_type: str, *folder_ids: Optional[str]):
+    """
+    Drop the cached listings of the given folders, None being the root.
+    """
+    for folder_id in folder_ids:
+        _listings.pop((entry_type, folder_id), None)
+
+
+def invalidate_listings(entry_type: str):
+    """
+    Drop every cached listing of the given entry type.
+    """
+    for key in [key for key in _listings if key[0] == entry_type]:
+        del _listings[key]
+    for key in [key for key in _aliases if key[0] == entry_type]:
+        del _aliases[key]
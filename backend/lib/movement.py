@@ -0,0 +1,165 @@
+import asyncio
+import math
+from bson import ObjectId
+from dataclasses import dataclass, field
+from pymongo import UpdateOne
+from typing import Optional
+
+from . import database, spatial
+from .errors import AuthError, JsonError
+from ..models.database_models import Connection, Permissions
+
+
+# Broadcasts per second of the tokens moving on each map
+TOKEN_MOVE_RATE = 20
+# Seconds between a move and writing token positions back
+TOKEN_WRITE_DELAY = 1.0
+
+
+@dataclass
+class MoveState:
+    map_id: str
+    # Token id -> latest position not yet broadcast, and who moved it there
+    unsent: dict[str, tuple[float, float, Connection]] = field(default_factory=dict)
+    # Token id -> where it was before its unsent moves
+    unsent_from: dict[str, Optional[spatial.Bounds]] = field(default_factory=dict)
+    # Token id -> latest position not yet written
+    unwritten: dict[str, tuple[float, float]] = field(default_factory=dict)
+    broadcast_task: Optional[asyncio.Task] = field(default=None, repr=False)
+    write_task: Optional[asyncio.Task] = field(default=None, repr=False)
+
+
+move_states: dict[str, MoveState] = {}
+# Map id -> ids of the users allowed to move its tokens, checked once each
+movers: dict[str, set[str]] = {}
+
+
+def move_token(connection: Connection, map_id: str, token_id: str, x: float, y: float):
+    """
+    Move a token without waiting for it to be broadcast or written. Moves
+    are broadcast at most TOKEN_MOVE_RATE times a second, with only the
+    latest position of each token, and written after TOKEN_WRITE_DELAY.
+    """
+    if not isinstance(map_id, str) or not ObjectId.is_valid(map_id):
+        raise JsonError("invalid map id")
+    if not isinstance(token_id, str):
+        raise JsonError("invalid token id")
+    if not all(isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value) for value in (x, y)):
+        raise JsonError("invalid position")
+
+    map_movers = movers.setdefault(map_id, set())
+    if connection.user.id not in map_movers:
+        map = database.maps.find_one(map_id, {"revealed_areas": 0})
+        if map is None:
+            raise JsonError("invalid map id")
+        if not connection.user.is_gm and not map.has_permission(connection.user.id, "*", Permissions.WRITE):
+            raise AuthError("insufficient permission")
+        map_movers.add(connection.user.id)
+
+    index = spatial.get_index(map_id)
+    if index.bounds(token_id) is None:
+        raise JsonError("invalid token id")
+
+    state = move_states.get(map_id)
+    if state is None:
+        state = MoveState(map_id)
+        move_states[map_id] = state
+    if token_id not in state.unsent:
+        state.unsent_from[token_id] = index.bounds(token_id)
+    state.unsent[token_id] = (x, y, connection)
+    state.unwritten[token_id] = (x, y)
+    index.move(token_id, x, y)
+
+    if state.broadcast_task is None:
+        state.broadcast_task = asyncio.create_task(broadcast_moves(state))
+    if state.write_task is None:
+        state.write_task = asyncio.create_task(delayed_write(state))
+
+
+async def broadcast_moves(state: MoveState):
+    # The first move goes out straight away, then whatever has moved since
+    # once per interval until things stop moving
+    try:
+        while state.unsent:
+            unsent, state.unsent = state.unsent, {}
+            unsent_from, state.unsent_from = state.unsent_from, {}
+            by_sender: dict[Connection, dict[str, float]] = {}
+            for token_id, (x, y, sender) in unsent.items():
+                changes = by_sender.setdefault(sender, {})
+                changes[f"tokens.{token_id}.x"] = x
+                changes[f"tokens.{token_id}.y"] = y
+            # Senders already show their own moves
+            for sender, changes in by_sender.items():
+                await spatial.broadcast_map_changes(state.map_id, {"$set": changes}, unsent_from, sender=sender)
+            await asyncio.sleep(1 / TOKEN_MOVE_RATE)
+    finally:
+        # Otherwise no later move would start broadcasting again
+        state.broadcast_task = None
+
+
+async def delayed_write(state: MoveState):
+    await asyncio.sleep(TOKEN_WRITE_DELAY)
+    state.write_task = None
+    write(state)
+
+
+def write(state: MoveState):
+    unwritten, state.unwritten = state.unwritten, {}
+    if not unwritten:
+        return
+    database.tokens.collection.bulk_write([
+        UpdateOne({"_id": ObjectId(token_id), "map_id": state.map_id}, {"$set": {"x": x, "y": y}})
+        for token_id, (x, y) in unwritten.items()
+    ], ordered=False)
+
+
+def get_unwritten(map_id: str) -> dict[str, tuple[float, float]]:
+    """
+    Get the positions of a map's tokens that have moved but not been
+    written yet, keyed by token id.
+    """
+    state = move_states.get(map_id)
+    return dict(state.unwritten) if state is not None else {}
+
+
+def discard_moves(map_id: str, token_id: str):
+    """
+    Drop the pending moves of a token, for when it is written or deleted
+    directly.
+    """
+    state = move_states.get(map_id)
+    if state is not None:
+        state.unsent.pop(token_id, None)
+        state.unsent_from.pop(token_id, None)
+        state.unwritten.pop(token_id, None)
+
+
+def forget_movers(map_id: str):
+    """
+    Check who can move a map's tokens again, for when its permissions change.
+    """
+    movers.pop(map_id, None)
+
+
+def forget_moves(map_id: str):
+    """
+    Drop everything pending for a map, for when it is deleted.
+    """
+    movers.pop(map_id, None)
+    state = move_states.pop(map_id, None)
+    if state is None:
+        return
+    for task in (state.broadcast_task, state.write_task):
+        if task is not None:
+            task.cancel()
+
+
+def write_all():
+    """
+    Write out every pending move, for shutdown.
+    """
+    for state in move_states.values():
+        if state.write_task is not None:
+            state.write_task.cancel()
+            state.write_task = None
+        write(state)
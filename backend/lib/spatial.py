@@ -0,0 +1,288 @@
+import functools
+import math
+import shapely
+from fastapi.encoders import jsonable_encoder
+from pathlib import Path
+from typing import Iterable, Optional
+
+from . import database
+from .enums import Layer, ScaleType
+from .files import get_dimensions
+from ..models.database_models import FILES_ROOT, Connection, Token, TokenPlacement, get_pool
+
+
+# Size of /unknown.png, which clients draw in place of images that fail to load
+UNKNOWN_IMAGE_SIZE = (256, 256)
+# Tokens changed since the tree was built are checked one by one, until there
+# are more than this many or an eighth of the map's tokens
+MIN_STALE_TOKENS = 64
+
+# (min x, min y, max x, max y)
+Bounds = tuple[float, float, float, float]
+
+
+@functools.lru_cache(maxsize=4096)
+def image_size(src: str) -> tuple[int, int]:
+    """
+    Get the pixel dimensions of a token image from its URL.
+    """
+    path = Path(src).resolve(strict=False)
+    dimensions = None
+    if path.is_relative_to(FILES_ROOT):
+        try:
+            dimensions = get_dimensions([path]).get(path)
+        except OSError:
+            pass
+    return tuple(dimensions) if dimensions else UNKNOWN_IMAGE_SIZE
+
+
+def token_bounds(token: TokenPlacement) -> Bounds:
+    """
+    Get the axis aligned box a token is drawn within, the way clients draw it:
+    centered on its position, sized in map units or as a scale of its image,
+    then rotated. The box also covers the token's hitbox.
+    """
+    if token.scale_type == ScaleType.ABSOLUTE:
+        width = token.width or 0.0
+        height = token.height or 0.0
+    else:
+        image_width, image_height = image_size(token.src) if token.src else UNKNOWN_IMAGE_SIZE
+        width = image_width * (token.width if token.width is not None else 1.0)
+        height = image_height * (token.height if token.height is not None else 1.0)
+    cos, sin = abs(math.cos(token.rotation)), abs(math.sin(token.rotation))
+    half_width = (abs(width) * cos + abs(height) * sin) / 2
+    half_height = (abs(width) * sin + abs(height) * cos) / 2
+    hitbox = max(token.hitbox_width or 0.0, token.hitbox_height or 0.0) / 2
+    half_width, half_height = max(half_width, hitbox), max(half_height, hitbox)
+    return (token.x - half_width, token.y - half_height, token.x + half_width, token.y + half_height)
+
+
+def intersects(a: Bounds, b: Bounds) -> bool:
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def hit_tokens(template: shapely.geometry.base.BaseGeometry, tokens: list[Token]) -> list[Token]:
+    """
+    Get the tokens whose hitbox intersects an area template. Hitboxes are
+    circles across the larger hitbox dimension, the way clients pick tokens,
+    and tokens without one are hit anywhere within their box.
+    """
+    hits = []
+    for token in tokens:
+        hitbox = max(token.hitbox_width or 0.0, token.hitbox_height or 0.0)
+        if hitbox > 0:
+            hit = template.distance(shapely.Point(token.x, token.y)) <= hitbox / 2
+        else:
+            hit = template.intersects(shapely.box(*token_bounds(token)))
+        if hit:
+            hits.append(token)
+    return hits
+
+
+def formation_positions(formation: str, count: int, spacing: float, x: float, y: float) -> list[tuple[float, float]]:
+    """
+    Get the positions of count tokens spacing apart, centered on (x, y):
+    a grid as close to square as possible, a line, or a circle.
+    """
+    if formation == "grid":
+        columns = math.ceil(math.sqrt(count))
+        rows = math.ceil(count / columns)
+        return [
+            (x + (index % columns - (columns - 1) / 2) * spacing, y + (index // columns - (rows - 1) / 2) * spacing)
+            for index in range(count)
+        ]
+    elif formation == "line":
+        return [(x + (index - (count - 1) / 2) * spacing, y) for index in range(count)]
+    elif formation == "circle":
+        if count == 1:
+            return [(x, y)]
+        # Far enough out that neighbours are spacing apart
+        radius = max(spacing, spacing / (2 * math.sin(math.pi / count)))
+        return [
+            (x + radius * math.cos(2 * math.pi * index / count), y + radius * math.sin(2 * math.pi * index / count))
+            for index in range(count)
+        ]
+    raise ValueError(f"unknown formation {formation}")
+
+
+class TokenIndex:
+    """
+    The bounds of every token on a map, with an STRtree to find those in an
+    area. STRtrees can't be changed once built, so tokens changed since are
+    kept aside and checked one by one until there are enough to rebuild.
+    """
+
+    def __init__(self, map_id: str, placements: Iterable[TokenPlacement]):
+        self.map_id = map_id
+        self.tokens: dict[str, tuple[Bounds, Layer]] = {
+            token.id: (token_bounds(token), token.layer)
+            for token in placements
+        }
+        self.rebuild()
+
+    def rebuild(self):
+        self.tree_ids = list(self.tokens)
+        self.tree = shapely.STRtree([shapely.box(*self.tokens[token_id][0]) for token_id in self.tree_ids])
+        self.stale: set[str] = set()
+
+    def bounds(self, token_id: str) -> Optional[Bounds]:
+        entry = self.tokens.get(token_id)
+        return entry[0] if entry is not None else None
+
+    def set(self, token: TokenPlacement):
+        self.tokens[token.id] = (token_bounds(token), token.layer)
+        self.mark_stale(token.id)
+
+    def move(self, token_id: str, x: float, y: float):
+        entry = self.tokens.get(token_id)
+        if entry is None:
+            return
+        (min_x, min_y, max_x, max_y), layer = entry
+        dx, dy = x - (min_x + max_x) / 2, y - (min_y + max_y) / 2
+        self.tokens[token_id] = ((min_x + dx, min_y + dy, max_x + dx, max_y + dy), layer)
+        self.mark_stale(token_id)
+
+    def remove(self, token_id: str):
+        if self.tokens.pop(token_id, None) is not None:
+            self.mark_stale(token_id)
+
+    def mark_stale(self, token_id: str):
+        self.stale.add(token_id)
+        if len(self.stale) > max(MIN_STALE_TOKENS, len(self.tokens) // 8):
+            self.rebuild()
+
+    def query(self, area: Bounds, layers: Optional[Iterable[Layer]] = None) -> list[str]:
+        """
+        Get the ids of the tokens intersecting an area, optionally only
+        those on the given layers.
+        """
+        token_ids = [
+            self.tree_ids[index]
+            for index in self.tree.query(shapely.box(*area))
+            if self.tree_ids[index] not in self.stale
+        ]
+        token_ids.extend(
+            token_id for token_id in self.stale
+            if token_id in self.tokens and intersects(self.tokens[token_id][0], area)
+        )
+        if layers is not None:
+            layers = set(layers)
+            token_ids = [token_id for token_id in token_ids if self.tokens[token_id][1] in layers]
+        return token_ids
+
+
+indexes: dict[str, TokenIndex] = {}
+
+
+def get_index(map_id: str) -> TokenIndex:
+    index = indexes.get(map_id)
+    if index is None:
+        index = TokenIndex(map_id, database.tokens.find_projected({"map_id": map_id}, TokenPlacement))
+        indexes[map_id] = index
+    return index
+
+
+def get_loaded_index(map_id: str) -> Optional[TokenIndex]:
+    return indexes.get(map_id)
+
+
+def update_token(map_id: str, token: TokenPlacement):
+    """
+    Bring a loaded index up to date with a token after it was written.
+    """
+    index = indexes.get(map_id)
+    if index is not None:
+        index.set(token)
+
+
+def remove_token(map_id: str, token_id: str):
+    index = indexes.get(map_id)
+    if index is not None:
+        index.remove(token_id)
+
+
+def refresh_token(map_id: str, token_id: str):
+    """
+    Bring a loaded index up to date with a token by reading it back.
+    """
+    index = indexes.get(map_id)
+    if index is None:
+        return
+    placements = database.tokens.find_projected({"id": token_id, "map_id": map_id}, TokenPlacement)
+    if placements:
+        index.set(placements[0])
+    else:
+        index.remove(token_id)
+
+
+def forget_index(map_id: str):
+    indexes.pop(map_id, None)
+
+
+def changed_token_ids(changes: dict) -> set[str]:
+    return {
+        key.split(".", 2)[1]
+        for fields in changes.values() if isinstance(fields, dict)
+        for key in fields
+        if key.startswith("tokens.")
+    }
+
+
+async def broadcast_map_changes(map_id: str, changes: dict, before: dict[str, Optional[Bounds]], sender: Optional[Connection] = None):
+    """
+    Send a map update to its subscribers, except the sender if given.
+    Connections with a viewport on the map only get the token changes for
+    tokens that were or are now in view, and the whole token when one comes
+    into view.
+    """
+    message = jsonable_encoder({"type": "update", "changes": changes, "pool": map_id})
+    for connection in list(get_pool(map_id)):
+        if connection is sender:
+            continue
+        # A connection closing mid broadcast is dropped from its pools by its
+        # own handler, the rest still get the update
+        try:
+            await send_map_changes(connection, map_id, message, before)
+        except Exception as e:
+            print("/api/live - Failed to send map update -", connection.user.name, e)
+
+
+async def send_map_changes(connection: Connection, map_id: str, message: dict, before: dict[str, Optional[Bounds]]):
+    index = indexes.get(map_id)
+    viewport = connection.viewports.get(map_id)
+    if viewport is None or index is None:
+        await connection.send(message)
+        return
+
+    filtered: dict[str, dict] = {}
+    entered: set[str] = set()
+    for operator, fields in message["changes"].items():
+        if not isinstance(fields, dict):
+            filtered[operator] = fields
+            continue
+        for key, value in fields.items():
+            path = key.split(".", 2)
+            if path[0] != "tokens" or len(path) < 2:
+                filtered.setdefault(operator, {})[key] = value
+                continue
+            was_visible = before.get(path[1]) is not None and intersects(before[path[1]], viewport)
+            bounds = index.bounds(path[1])
+            is_visible = bounds is not None and intersects(bounds, viewport)
+            if was_visible:
+                filtered.setdefault(operator, {})[key] = value
+            elif is_visible:
+                # Whole tokens can be sent as they are
+                if operator == "$set" and len(path) == 2:
+                    filtered.setdefault(operator, {})[key] = value
+                else:
+                    entered.add(path[1])
+
+    # The connection doesn't have tokens that were out of view, so send
+    # them whole rather than just what changed
+    for token_id in entered:
+        token = database.tokens.find_one({"id": token_id, "map_id": map_id})
+        if token is not None:
+            filtered.setdefault("$set", {})[f"tokens.{token_id}"] = jsonable_encoder(token)
+
+    if filtered:
+        await connection.send({**message, "changes": filtered})
@@ -0,0 +1,97 @@
+import asyncio
+import os
+from bson import ObjectId
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Optional
+
+from . import database
+
+
+# Seconds between sweeps for temporary characters no token refers to
+REAP_INTERVAL = float(os.environ.get("TEMPORARY_REAP_INTERVAL", 3600))
+# Temporary characters are created before the tokens that refer to them, so
+# new ones are left alone for this many seconds
+REAP_GRACE = float(os.environ.get("TEMPORARY_REAP_GRACE", 300))
+
+# Strong reference to the periodic sweep so it isn't garbage collected
+reap_task: Optional[asyncio.Task] = None
+
+
+def delete_temporary_characters(character_ids: Iterable[str]) -> int:
+    """
+    Delete those of the given characters that are temporary, for when the
+    tokens referring to them are deleted. Returns how many were deleted.
+    """
+    ids = [ObjectId(id) for id in set(character_ids) if isinstance(id, str) and ObjectId.is_valid(id)]
+    if not ids:
+        return 0
+    return database.characters.delete_many({"_id": {"$in": ids}, "temporary": True})
+
+
+def find_orphaned_characters() -> list[ObjectId]:
+    """
+    Find the temporary characters older than REAP_GRACE that no token or
+    combatant refers to, in one aggregation.
+    """
+    created_before = ObjectId.from_datetime(datetime.now(timezone.utc) - timedelta(seconds=REAP_GRACE))
+    pipeline = [
+        {"$match": {"temporary": True, "_id": {"$lt": created_before}}},
+        {"$project": {"_id": 1, "id": {"$toString": "$_id"}}},
+        {"$lookup": {
+            "from": database.tokens.name,
+            "let": {"id": "$id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$character_id", "$$id"]}}},
+                {"$limit": 1},
+                {"$project": {"_id": 1}},
+            ],
+            "as": "tokens",
+        }},
+        {"$match": {"tokens": {"$size": 0}}},
+        {"$lookup": {
+            "from": database.combats.name,
+            "localField": "id",
+            "foreignField": "combatants.character_id",
+            "pipeline": [{"$limit": 1}, {"$project": {"_id": 1}}],
+            "as": "combats",
+        }},
+        {"$match": {"combats": {"$size": 0}}},
+        {"$project": {"_id": 1}},
+    ]
+    return [document["_id"] for document in database.characters.collection.aggregate(pipeline)]
+
+
+def reap_orphaned_characters() -> dict[str, int]:
+    """
+    Delete every orphaned temporary character, returning how many temporary
+    characters there were and how many were deleted.
+    """
+    temporary = database.characters.collection.count_documents({"temporary": True})
+    orphaned = find_orphaned_characters()
+    deleted = database.characters.delete_many({"_id": {"$in": orphaned}, "temporary": True}) if orphaned else 0
+    return {"temporary": temporary, "orphaned": len(orphaned), "deleted": deleted}
+
+
+async def reap_periodically():
+    while True:
+        await asyncio.sleep(REAP_INTERVAL)
+        try:
+            counts = reap_orphaned_characters()
+        except Exception as e:
+            print("Reaping temporary characters failed -", e)
+            continue
+        if counts["deleted"]:
+            print("Reaped temporary characters -", counts)
+
+
+def start_reaping():
+    global reap_task
+    if reap_task is None:
+        reap_task = asyncio.create_task(reap_periodically())
+
+
+def stop_reaping():
+    global reap_task
+    if reap_task is not None:
+        reap_task.cancel()
+        reap_task = None
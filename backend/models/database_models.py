@@ -6,7 +6,7 @@ from datetime import datetime
 from fastapi import WebSocket
 from fastapi.encoders import jsonable_encoder
 from pathlib import Path
-from pydantic import BaseModel, Field, GetCoreSchemaHandler, GetJsonSchemaHandler
+from pydantic import BaseModel, Field, GetCoreSchemaHandler, GetJsonSchemaHandler, PrivateAttr
 from pydantic_core import core_schema
 from pydantic.functional_serializers import PlainSerializer
 from pydantic.functional_validators import BeforeValidator
@@ -78,10 +78,17 @@ class _GeometryAnnotation:
             core_schema.no_info_plain_validator_function(shapely.geometry.shape),
         ])
 
+        # Stored as WKB, or GeoJSON from before it was
+        from_wkb_schema = core_schema.chain_schema([
+            core_schema.bytes_schema(strict=True),
+            core_schema.no_info_plain_validator_function(shapely.from_wkb),
+        ])
+
         return core_schema.json_or_python_schema(
             json_schema=from_dict_schema,
             python_schema=core_schema.union_schema([
                 core_schema.is_instance_schema(shapely.geometry.base.BaseGeometry),
+                from_wkb_schema,
                 from_dict_schema,
             ]),
             serialization=core_schema.plain_serializer_function_ser_schema(shapely.geometry.mapping),
@@ -106,6 +113,9 @@ class Connection:
     user: User
     websocket: WebSocket
     pools: set[Pool] = field(default_factory=set)
+    # Pool name -> (min x, min y, max x, max y) of the area this connection
+    # is looking at, for map pools where it only wants tokens in view
+    viewports: dict[str, tuple[float, float, float, float]] = field(default_factory=dict)
 
     async def send(self, jsonable):
         await self.websocket.send_json(jsonable)
@@ -154,6 +164,19 @@ def get_pool(request: Union[str, dict[str, Any]]):
     return pool
 
 
+async def broadcast_batch(messages: list[dict[str, Any]]):
+    """
+    Send messages bound for several pools, each connection getting all of
+    those for the pools it is in as one batch.
+    """
+    batches: dict[Connection, list[dict[str, Any]]] = {}
+    for message in messages:
+        for connection in get_pool(message["pool"]):
+            batches.setdefault(connection, []).append(message)
+    for connection, batch in batches.items():
+        await connection.send({"type": "batch", "messages": batch})
+
+
 def new_permissions():
     return {"*": {"*": Permissions.NONE}}
 
@@ -174,6 +197,14 @@ class CharacterAbility(BaseModel):
     rolls: list[Roll] = Field(default_factory=list)
 
 
+class Effect(BaseModel):
+    id: str
+    name: str = ""
+    description: str = ""
+    # Round of the combat it was added in that it ends on
+    end_round: int = 0
+
+
 class Stat(BaseModel):
     id: str
     name: str
@@ -189,25 +220,15 @@ class Session(BaseModel):
     last_auth_date: datetime = Field(default_factory=datetime.utcnow)
 
 
-class Entry(BaseModel):
+class EntrySummary(BaseModel):
     id: str = None
     name: Optional[str] = None
     permissions: dict[str, dict[str, Permissions]] = Field(default_factory=new_permissions)
-    data: dict = Field(default_factory=dict)
     image: str = ""
-
-    def __hash__(self):
-        return hash(self.id)
-
-    @property
-    def pool(self):
-        return get_pool(self.id)
-
-    async def broadcast_changes(self, changes: dict):
-        await self.pool.broadcast(jsonable_encoder({
-            "type": "update",
-            "changes": changes,
-        }))
+    # Requester id -> (field -> level, level of any other field), or None for
+    # instances that don't memoize. An instance holds one revision of a
+    # document, so this only needs resetting when add_permission changes it.
+    _resolved_permissions: Optional[dict[str, tuple[dict[str, Permissions], Permissions]]] = PrivateAttr(default=None)
 
     def add_permission(self, id: str = "*", field: str = "*", level: Permissions = Permissions.READ):
         """
@@ -218,12 +239,65 @@ class Entry(BaseModel):
             sub_permissions = {}
             self.permissions[id] = sub_permissions
         sub_permissions[field] = max(sub_permissions.get(field, Permissions.INHERIT), level)
+        if self._resolved_permissions is not None:
+            self._resolved_permissions = {}
+
+    def memoize_permissions(self):
+        """
+        Keep the permissions of each requester once resolved. Resolving costs
+        more than looking up a field directly, so this is only worth it for
+        instances that are kept and checked again, like cached listings.
+        """
+        if self._resolved_permissions is None:
+            self._resolved_permissions = {}
+
+    def resolve_permissions(self, id: str = "*") -> tuple[dict[str, Permissions], Permissions]:
+        """
+        Flatten the permissions of the given ID into the level for each field
+        named in this entry's permissions, and the level for any other field.
+
+        A requester's sub-dictionary is used unless it is missing, each field
+        falling back to its "*" field, falling back to INHERIT. Fields that
+        resolve to INHERIT for a specific ID take the level of "*" instead.
+        """
+        # Private attributes are looked up through __getattr__, which costs more
+        # than the lookups this saves, so go to their storage directly
+        memo = self.__pydantic_private__["_resolved_permissions"]
+        resolved = memo.get(id) if memo is not None else None
+        if resolved is not None:
+            return resolved
+
+        everyone = self.permissions.get("*", {"*": Permissions.INHERIT})
+        everyone_default = everyone.get("*", Permissions.INHERIT)
+        entity = self.permissions.get(id, None)
+        if id == "*" or entity is None:
+            resolved = (everyone, everyone_default)
+        else:
+            entity_default = entity.get("*", Permissions.INHERIT)
+            levels = {}
+            for field in everyone.keys() | entity.keys():
+                level = entity.get(field, entity_default)
+                if level == Permissions.INHERIT:
+                    level = everyone.get(field, everyone_default)
+                levels[field] = level
+            if entity_default == Permissions.INHERIT:
+                entity_default = everyone_default
+            resolved = (levels, entity_default)
+
+        if memo is not None:
+            memo[id] = resolved
+        return resolved
 
     def get_permission(self, id: str = "*", field: str = "*") -> Permissions:
         """
         Get the permissions enum for the given ID accessing the given field
         on this entry.
         """
+        memo = self.__pydantic_private__["_resolved_permissions"]
+        if memo is not None:
+            levels, default = memo.get(id) or self.resolve_permissions(id)
+            return levels.get(field, default)
+
         # Get the permissions associated with the requesting entity
         entity_permissions = self.permissions.get(id, None)
         if entity_permissions is None:
@@ -243,6 +317,79 @@ class Entry(BaseModel):
         """
         return self.get_permission(id, field) >= level
 
+    @staticmethod
+    def permission_filter(id: str = "*", field: str = "*", level: Permissions = Permissions.READ) -> dict:
+        """
+        Get a Mongo filter matching the documents where has_permission(id, field, level)
+        would be true.
+
+        get_permission resolves a sub-dictionary to its exact field, falling back to
+        its "*" field, falling back to INHERIT. The requester's sub-dictionary is used
+        unless it is missing or resolves to INHERIT, in which case "*" is used.
+        """
+        def resolves_to_level(entity: str) -> dict:
+            if field == "*":
+                return {f"permissions.{entity}.*": {"$gte": level}}
+            return {"$or": [
+                {f"permissions.{entity}.{field}": {"$gte": level}},
+                {f"permissions.{entity}.{field}": {"$exists": False}, f"permissions.{entity}.*": {"$gte": level}},
+            ]}
+
+        def resolves_to_inherit(entity: str) -> dict:
+            # A missing value is INHERIT, $in with None matches missing fields
+            if field == "*":
+                return {f"permissions.{entity}.*": {"$in": [None, Permissions.INHERIT]}}
+            return {"$or": [
+                {f"permissions.{entity}.{field}": Permissions.INHERIT},
+                {
+                    f"permissions.{entity}.{field}": {"$exists": False},
+                    f"permissions.{entity}.*": {"$in": [None, Permissions.INHERIT]},
+                },
+            ]}
+
+        # Every document has at least INHERIT
+        if level <= Permissions.INHERIT:
+            return {}
+
+        if id == "*":
+            result = resolves_to_level("*")
+        else:
+            result = {"$or": [
+                resolves_to_level(id),
+                {"$and": [resolves_to_inherit(id), resolves_to_level("*")]},
+            ]}
+
+        # Documents without permissions get new_permissions() when loaded
+        if level <= Permissions.NONE:
+            result = {"$or": [result, {"permissions": {"$exists": False}}]}
+        return result
+
+
+class AbilitySummary(EntrySummary):
+    type: AbilityType = AbilityType.PASSIVE
+    cooldown: int = 0
+
+
+class FolderSummary(EntrySummary):
+    parent_id: Optional[str] = None
+
+
+class Entry(EntrySummary):
+    data: dict = Field(default_factory=dict)
+
+    def __hash__(self):
+        return hash(self.id)
+
+    @property
+    def pool(self):
+        return get_pool(self.id)
+
+    async def broadcast_changes(self, changes: dict):
+        await self.pool.broadcast(jsonable_encoder({
+            "type": "update",
+            "changes": changes,
+        }))
+
 
 class Entity(Entry):
     stat_map: dict[str, Stat] = Field(default_factory=dict)
@@ -272,12 +419,21 @@ class Item(Entity, Container):
 class Folder(Entry):
     entry_type: str = "folder"
     parent_id: Optional[str] = None
+    ancestors: list[str] = Field(default_factory=list)
     alternate_id: Optional[str] = None
 
+    @property
+    def lineage(self) -> list[str]:
+        """
+        The ids of this folder's ancestors from the root down, followed by its own id.
+        """
+        return self.ancestors + [self.id]
+
 
 class Character(Entity, Container):
     entry_type: str = "character"
     folder_id: Optional[str] = None
+    ancestors: list[str] = Field(default_factory=list)
     description: str = ""
     alignment: Alignment = Alignment.NEUTRAL
     hp: float = 0
@@ -292,12 +448,16 @@ class Character(Entity, Container):
     sheet_type: str = "default"
     ability_map: dict[str, CharacterAbility] = Field(default_factory=dict)
     ability_order: list[str] = Field(default_factory=list)
+    # Ability id -> round its cooldown ends on
+    cooldowns: dict[str, int] = Field(default_factory=dict)
+    effect_map: dict[str, Effect] = Field(default_factory=dict)
     temporary: bool = False
 
 
 class Ability(Entry):
     entry_type: str = "ability"
     folder_id: Optional[str] = None
+    ancestors: list[str] = Field(default_factory=list)
     sheet_type: str = "default"
     description: str = ""
     type: AbilityType = AbilityType.PASSIVE
@@ -308,6 +468,7 @@ class Ability(Entry):
 class Note(Entry):
     entry_type: str = "note"
     folder_id: Optional[str] = None
+    ancestors: list[str] = Field(default_factory=list)
     text: str = ""
 
 
@@ -339,9 +500,49 @@ class Combatant(Entry):
     initiative: Optional[float] = None
 
 
+class ScheduledExpiry(BaseModel):
+    """
+    A cooldown or effect on a character that ends when a combat reaches a
+    round and turn.
+    """
+    id: str
+    round: int
+    turn: int
+    character_id: str
+    ability_id: Optional[str] = None
+    effect_id: Optional[str] = None
+
+
 class Combat(Entry):
     entry_type: str = "combat"
     combatants: list[Combatant] = Field(default_factory=list)
+    # Index into combatants of whose turn it is
+    turn_index: int = 0
+    round: int = 1
+    scheduled: list[ScheduledExpiry] = Field(default_factory=list)
+
+    @property
+    def current_combatant(self) -> Optional[Combatant]:
+        if not self.combatants:
+            return None
+        return self.combatants[self.turn_index % len(self.combatants)]
+
+
+class TokenPlacement(BaseModel):
+    """
+    The fields of a token that decide where on the map it is drawn.
+    """
+    id: str = None
+    layer: Layer = Layer.CHARACTERS
+    src: str = ""
+    x: float = 0.0
+    y: float = 0.0
+    width: float = None
+    height: float = None
+    scale_type: ScaleType = ScaleType.RELATIVE
+    rotation: float = 0.0
+    hitbox_width: float = None
+    hitbox_height: float = None
 
 
 class Token(Entry):
@@ -358,12 +559,13 @@ class Token(Entry):
     scale_type: ScaleType = ScaleType.RELATIVE
     rotation: float = 0.0
     character_id: str = None
+    map_id: str = None
 
 
 class Map(Entry):
     entry_type: str = "map"
-    tokens: dict[str, Token] = Field(default_factory=dict)
     revealed_areas: Optional[Geometry] = None
+    reveal_revision: int = 0
     squareSize: int = 150
     gridColor: GridColor = GridColor.WHITE
     backgroundColor: int = "000000"
@@ -2,10 +2,10 @@ import * as PIXI from "pixi.js";
 import { GlowFilter } from "pixi-filters";
 
 import * as ContextMenu from "./ContextMenu.ts";
-import { lerp, Parameter, Require, IsDefined, colorInterpolate } from "./Utils.ts";
+import { lerp, Parameter, Require, IsDefined, colorInterpolate, HasPermission } from "./Utils.ts";
 import { Vector2 } from "./Vector.ts";
-import { Layer } from "./Enums.ts";
-import { ApiRequest, Session } from "./Requests.ts";
+import { Layer, Permissions } from "./Enums.ts";
+import { ApiRequest, Session, WsSend } from "./Requests.ts";
 import { GridFilter } from "../filters/Grid.ts";
 import { launchWindow, windows, InputDialog } from "../windows/Window.ts";
 import { ScaleType } from "./Models.ts";
@@ -37,8 +37,6 @@ function drawPolygon(graphics: PIXI.Graphics, polygon: [number, number][][]) {
 
 
 function drawGeometry(graphics: PIXI.Graphics, geometry: any) {
-    graphics.clear();
-
     if (!geometry || !geometry.coordinates || geometry.coordinates.length == 0) {
         return;
     }
@@ -606,11 +604,14 @@ export class MapCanvas extends Canvas {
     effectContainer: CanvasContainer;
     uiContainer: CanvasContainer;
     fogMask: PIXI.Graphics;
+    fogChunks: { [key: string]: any };
+    revealRevision: number;
     highestZIndex: number;
     squareSize: number;
     selectedTokens: Set<PIXI.Sprite>;
     snapping: boolean;
     tool: string | null;
+    canWrite: boolean;
 
     constructor() {
         super();
@@ -620,6 +621,7 @@ export class MapCanvas extends Canvas {
         this.squareSize = 1;
         this.selectedTokens = new Set();
         this.tool = null;
+        this.canWrite = false;
     }
 
     getElementAtScreenPos(x: number, y: number): PIXI.Container {
@@ -877,6 +879,20 @@ export class MapCanvas extends Canvas {
             }, 250);
         });
 
+        sprite.on("drag", () => {
+            // The server drops moves from users who can't write the map
+            if (!this.canWrite) {
+                return;
+            }
+            WsSend({
+                type: "move-token",
+                pool: this.id,
+                token: token.id,
+                x: sprite.x,
+                y: sprite.y,
+            });
+        });
+
         sprite.on("translate", async () => {
             await ApiRequest("/map/update", {
                 id: this.id,
@@ -957,6 +973,7 @@ export class MapCanvas extends Canvas {
                 for (const selectedSprite of selectedSprites) {
                     selectedSprite.x += dragDelta.x;
                     selectedSprite.y += dragDelta.y;
+                    selectedSprite.emit("drag");
                 }
             }
 
@@ -1113,6 +1130,7 @@ export class MapCanvas extends Canvas {
     async render(map, translation, scale) {
         this.id = map.id;
         this.squareSize = map.squareSize;
+        this.canWrite = HasPermission(map, Session.id, "*", Permissions.WRITE);
 
         this.tokenNodes = {};
         if (this.fogMask) {
@@ -1143,7 +1161,9 @@ export class MapCanvas extends Canvas {
         this.fogMask.y = translation.y;
         this.fogMask.scale = scale;
 
-        this.onRevealChange(map.revealed_areas);
+        this.fogChunks = map.revealed_chunks;
+        this.revealRevision = map.reveal_revision;
+        this.drawFog();
 
         this.grid = root.AddGrid({
             width: this.htmlContainer.offsetWidth,
@@ -1166,8 +1186,47 @@ export class MapCanvas extends Canvas {
         }
     }
 
-    onRevealChange(revealed_areas) {
-        drawGeometry(this.fogMask, revealed_areas);
+    drawFog() {
+        this.fogMask.clear();
+        for (const geometry of Object.values(this.fogChunks)) {
+            drawGeometry(this.fogMask, geometry);
+        }
+    }
+
+    async onFogChange(revision: number, chunks: { [key: string]: any }) {
+        // Already part of what was last loaded
+        if (revision <= this.revealRevision) {
+            return;
+        }
+        // Chunks can only be patched in order, reload them after a missed edit
+        if (revision != this.revealRevision + 1) {
+            await this.resyncFog();
+            return;
+        }
+        for (const [key, geometry] of Object.entries(chunks)) {
+            if (geometry === null) {
+                delete this.fogChunks[key];
+            }
+            else {
+                this.fogChunks[key] = geometry;
+            }
+        }
+        this.revealRevision = revision;
+        this.drawFog();
+    }
+
+    async resyncFog() {
+        const response: {
+            status: string,
+            revision: number,
+            chunks: { [key: string]: any },
+        } = await ApiRequest("/map/fog", { id: this.id });
+        if (response.status != "success" || response.revision < this.revealRevision) {
+            return;
+        }
+        this.fogChunks = response.chunks;
+        this.revealRevision = response.revision;
+        this.drawFog();
     }
 }
 
@@ -70,6 +70,13 @@ export interface CharacterAbility {
     rolls: Roll[];
 }
 
+export interface Effect {
+    id: string;
+    name: string;
+    description: string;
+    end_round: number;
+}
+
 export interface Entry {
     entry_type: string;
     id: string;
@@ -143,6 +150,8 @@ export interface Character extends Entity {
     item_order: string[];
     ability_map: { [id: string]: CharacterAbility };
     ability_order: string[];
+    cooldowns: { [abilityId: string]: number };
+    effect_map: { [id: string]: Effect };
     temporary: boolean;
 }
 
@@ -161,4 +170,16 @@ export interface Combatant extends Entry {
 export interface Combat extends Entry {
     entry_type: "combat";
     combatants: Combatant[];
+    turn_index: number;
+    round: number;
+    scheduled: ScheduledExpiry[];
+}
+
+export interface ScheduledExpiry {
+    id: string;
+    round: number;
+    turn: number;
+    character_id: string;
+    ability_id: string;
+    effect_id: string;
 }
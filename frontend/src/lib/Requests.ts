@@ -15,6 +15,12 @@ export class Session {
 
 
 export function HandleWsMessage(data: any) {
+    if (data.type == "batch") {
+        for (const message of data.messages) {
+            HandleWsMessage(message);
+        }
+        return;
+    }
     const pool = Session.subscriptions[data.pool];
     if (!pool) {
         console.warn(`Ignoring message bound for pool: ${data.pool}`)
@@ -69,6 +75,13 @@ export async function WsConnect() {
 }
 
 
+export function WsSend(message: any) {
+    if (Session.ws && Session.ws.readyState == WebSocket.OPEN) {
+        Session.ws.send(JSON.stringify(message));
+    }
+}
+
+
 export class Subscription {
     pool: string;
     callback: CallableFunction;
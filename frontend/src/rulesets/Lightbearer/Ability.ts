@@ -69,7 +69,11 @@ async function onAbilityEdit(ability: Ability) {
 
 
 export async function onAbilityContextMenu(ability: Ability, contextMenuOptions: { [choice: string]: (ev: MouseEvent) => void }) {
-    contextMenuOptions["Edit"] = () => onAbilityEdit(ability);
+    contextMenuOptions["Edit"] = async () => {
+        // Folder listings only include summaries, so fetch the whole ability
+        const response = await ApiRequest("/ability/get", { id: ability.id });
+        await onAbilityEdit(response.ability);
+    };
 }
 
 
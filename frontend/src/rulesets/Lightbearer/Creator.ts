@@ -252,7 +252,7 @@ export async function LightbearerCreatorRender(container: HTMLDivElement, data:
         parent_id: string,
         subfolders: [string, string][],
         entries: Ability[],
-    } = await ApiRequest("/folder/ability/list", { folder_id: "Lightbearer.BasicActions" });
+    } = await ApiRequest("/folder/ability/list", { folder_id: "Lightbearer.BasicActions", full: true });
 
     basicAbilities = basicResponse.entries;
 
@@ -262,7 +262,7 @@ export async function LightbearerCreatorRender(container: HTMLDivElement, data:
         parent_id: string,
         subfolders: [string, string][],
         entries: Ability[],
-    } = await ApiRequest("/folder/ability/list", { folder_id: "Lightbearer.Weapons" });
+    } = await ApiRequest("/folder/ability/list", { folder_id: "Lightbearer.Weapons", full: true });
 
     for (const ability of weaponResponse.entries) {
         weaponData[ability.name] = ability;
@@ -296,7 +296,7 @@ export async function LightbearerCreatorRender(container: HTMLDivElement, data:
             parent_id: string,
             subfolders: [string, string][],
             entries: Ability[],
-        } = await ApiRequest("/folder/ability/list", { folder_id: `Lightbearer.Classes.${className}` });
+        } = await ApiRequest("/folder/ability/list", { folder_id: `Lightbearer.Classes.${className}`, full: true });
 
         if (response.status !== "success") {
             ErrorToast(`Failed to load class: ${className}`);
@@ -343,7 +343,7 @@ export async function LightbearerCreatorRender(container: HTMLDivElement, data:
             parent_id: string,
             subfolders: [string, string][],
             entries: Ability[],
-        } = await ApiRequest("/folder/ability/list", { folder_id: `Lightbearer.Races.${race}` });
+        } = await ApiRequest("/folder/ability/list", { folder_id: `Lightbearer.Races.${race}`, full: true });
 
         if (response.status !== "success") {
             ErrorToast(`Failed to load race: ${race}`);
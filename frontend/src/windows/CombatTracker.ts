@@ -115,15 +115,9 @@ export class CombatTrackerWindow extends ContentWindow {
                 <button type="button" class="add"><i class="fa-solid fa-dice"></i></button>
             `));
             rollAllButton.addEventListener("click", async () => {
-                const changes = {};
-                for (const [_id, index] of Object.entries(this.combatantIndexes)) {
-                    changes[`combatants.${index}.initiative`] = Roll("2d6").total;
-                }
-                await ApiRequest("/combat/update", {
+                await ApiRequest("/combat/roll-initiative", {
                     id: this.combatId,
-                    changes: {
-                        "$set": changes,
-                    },
+                    formula: "2d6",
                 });
             });
         }
@@ -372,8 +366,13 @@ export class CombatTrackerWindow extends ContentWindow {
             }
         }
 
+        this.setTitle(`Combat Tracker - Round ${combat.round}`);
+        for (const combatantElement of Object.values(this.combatantElements)) {
+            combatantElement.classList.remove("current");
+        }
         if (combat.combatants.length > 0) {
-            const currentCombatant = combat.combatants[0];
+            const currentCombatant = combat.combatants[combat.turn_index % combat.combatants.length];
+            this.combatantElements[currentCombatant.id].classList.add("current");
             if (HasPermission(currentCombatant, Session.id, "*", Permissions.WRITE)) {
                 this.endTurnButton.style.display = null;
             }
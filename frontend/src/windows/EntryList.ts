@@ -12,6 +12,9 @@ import { FolderPermissionsWindow } from "./FolderPermissions.ts";
 import { Entry } from "../lib/Models.ts";
 
 
+const ENTRY_PAGE_SIZE = 200;
+
+
 export class EntryListWindow extends ContentWindow {
     entryType: string;
     entryList: HTMLDivElement;
@@ -19,6 +22,8 @@ export class EntryListWindow extends ContentWindow {
     createFolderButton: HTMLButtonElement;
     folderId: string;
     ancestorIds: Set<string>;
+    nextCursor: string;
+    loadingPage: boolean;
 
     constructor(options) {
         Require(options.entryType);
@@ -45,6 +50,8 @@ export class EntryListWindow extends ContentWindow {
 
         this.folderId = null;
         this.ancestorIds = new Set();
+        this.nextCursor = null;
+        this.loadingPage = false;
     }
 
     async contextMenuHook(_type: string, _id: string, _contextOptions: { [choice: string]: (ev: MouseEvent) => void }) { }
@@ -159,7 +166,14 @@ export class EntryListWindow extends ContentWindow {
         AddDragListener(element, { type: `${this.entryType}Entry`, id: entry.id });
         const contextOptions = {
             "Duplicate": async () => {
-                const newEntry = structuredClone(entry);
+                // Folder listings only include summaries, so fetch the whole entry
+                const response = await ApiRequest(`/${this.entryType}/get`, { id: entry.id });
+                if (response.status != "success") {
+                    ErrorToast(`Failed to duplicate ${this.entryType}.`);
+                    return;
+                }
+                const newEntry = response[this.entryType];
+                delete newEntry.id;
                 newEntry.name += " (Copy)";
                 await ApiRequest(`/${this.entryType}/create`, {
                     document: newEntry
@@ -203,6 +217,42 @@ export class EntryListWindow extends ContentWindow {
         this.entryList.appendChild(element);
     }
 
+    async loadNextPage() {
+        if (this.nextCursor === null || this.loadingPage) {
+            return;
+        }
+        // Wait until the user scrolls near the end of what's loaded
+        if (this.viewPort.scrollTop + this.viewPort.clientHeight < this.viewPort.scrollHeight - 200) {
+            return;
+        }
+
+        this.loadingPage = true;
+        try {
+            const response: {
+                status: string,
+                entries: Entry[],
+                next: string,
+            } = await ApiRequest(`/folder/${this.entryType}/list`, {
+                folder_id: this.folderId,
+                limit: ENTRY_PAGE_SIZE,
+                after: this.nextCursor,
+            });
+            if (response.status != "success") {
+                ErrorToast(`Failed to load ${this.entryType} list.`);
+                return;
+            }
+            for (let entry of response.entries) {
+                await this.addEntry(entry);
+            }
+            this.nextCursor = response.next;
+        }
+        finally {
+            this.loadingPage = false;
+        }
+        // The page may not have filled the window
+        await this.loadNextPage();
+    }
+
     async load(folderId?: string) {
         await super.load();
         this.entryList.innerHTML = "";
@@ -218,7 +268,9 @@ export class EntryListWindow extends ContentWindow {
             parent_id: string,
             subfolders: [string, string][],
             entries: Entry[],
-        } = await ApiRequest(`/folder/${this.entryType}/list`, { folder_id: this.folderId });
+            total: number,
+            next: string,
+        } = await ApiRequest(`/folder/${this.entryType}/list`, { folder_id: this.folderId, limit: ENTRY_PAGE_SIZE });
         if (response.status != "success") {
             ErrorToast(`Failed to load ${this.entryType} list.`);
             this.close();
@@ -240,6 +292,9 @@ export class EntryListWindow extends ContentWindow {
         for (let entry of response.entries) {
             await this.addEntry(entry);
         }
+        this.nextCursor = response.next;
+        this.addEventListener(this.viewPort, "scroll", () => this.loadNextPage());
+        await this.loadNextPage();
 
         this.addDropListener(this.viewPort, async (dropData) => {
             await this.onDrop(this.folderId, dropData);
@@ -153,7 +153,10 @@ export class FileWindow extends ContentWindow {
             }
         }
 
-        await this.subscribe("files", () => {
+        await this.subscribe("files", update => {
+            if (update.type == "delete-progress") {
+                return;
+            }
             this.refresh();
         });
     }
@@ -1,6 +1,6 @@
 import * as PIXI from "pixi.js";
 
-import { CanvasWindow, registerWindowType } from "./Window.ts";
+import { CanvasWindow, InputDialog, registerWindowType } from "./Window.ts";
 import { Parameter, GenerateId, LocalPersist } from "../lib/Utils.ts";
 import { Vector2 } from "../lib/Vector.ts";
 import { ApiRequest, Session } from "../lib/Requests.ts";
@@ -553,6 +553,30 @@ export class MapWindow extends CanvasWindow {
                     }
                 });
             }
+            else if (data.type == "characterEntry" && ev.shiftKey) {
+                // Shift-dropping a character spawns a group of temporary copies
+                const selection = await InputDialog(
+                    "Spawn Tokens",
+                    {
+                        "Count": ["number", 5],
+                        "Formation": ["select", { "grid": "Grid", "line": "Line", "circle": "Circle" }, "grid"],
+                    },
+                    "Spawn"
+                );
+                if (!selection || !selection.Count) {
+                    return;
+                }
+                const worldCoords = this.canvas.ScreenToWorldCoords(new Vector2(ev.clientX, ev.clientY));
+                await ApiRequest("/map/spawn", {
+                    id: this.mapId,
+                    character_id: data.id,
+                    count: Math.floor(selection.Count),
+                    x: worldCoords.x,
+                    y: worldCoords.y,
+                    formation: selection.Formation,
+                    layer: this.activeLayer,
+                });
+            }
             else if (data.type == "characterEntry" || data.type == "character") {
                 let character: Character = null;
                 if (data.type == "characterEntry") {
@@ -643,9 +667,6 @@ export class MapWindow extends CanvasWindow {
                             const gridFilter = this.canvas.grid.filters[0] as GridFilter;
                             gridFilter.uniforms.uPitch = new PIXI.Point(value as number, value as number);
                         }
-                        else if (key == "revealed_areas") {
-                            this.canvas.onRevealChange(value);
-                        }
                         else {
                             simpleChanges = false;
                             break;
@@ -660,6 +681,9 @@ export class MapWindow extends CanvasWindow {
             else if (update.type == "ping") {
                 await this.canvas.Ping(update.x, update.y);
             }
+            else if (update.type == "fog") {
+                await this.canvas.onFogChange(update.revision, update.chunks);
+            }
         });
     }
 }
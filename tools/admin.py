@@ -39,6 +39,46 @@ def list_users(args):
     print(response.content)
 
 
+def rebuild_asset_index(args):
+    response = requests.post(
+        f"{BASE_URL}/admin/rebuild-asset-index",
+        json={
+            "admin_token": ADMIN_TOKEN,
+        }
+    )
+    print(response.content)
+
+
+def fog_metrics(args):
+    response = requests.post(
+        f"{BASE_URL}/admin/fog-metrics",
+        json={
+            "admin_token": ADMIN_TOKEN,
+        }
+    )
+    print(response.content)
+
+
+def write_behind_metrics(args):
+    response = requests.post(
+        f"{BASE_URL}/admin/write-behind-metrics",
+        json={
+            "admin_token": ADMIN_TOKEN,
+        }
+    )
+    print(response.content)
+
+
+def reap_temporary(args):
+    response = requests.post(
+        f"{BASE_URL}/admin/reap-temporary",
+        json={
+            "admin_token": ADMIN_TOKEN,
+        }
+    )
+    print(response.content)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers()
@@ -51,6 +91,18 @@ if __name__ == "__main__":
     list_users_parser = subparsers.add_parser("list_users")
     list_users_parser.set_defaults(func=list_users)
 
+    rebuild_asset_index_parser = subparsers.add_parser("rebuild_asset_index")
+    rebuild_asset_index_parser.set_defaults(func=rebuild_asset_index)
+
+    fog_metrics_parser = subparsers.add_parser("fog_metrics")
+    fog_metrics_parser.set_defaults(func=fog_metrics)
+
+    write_behind_metrics_parser = subparsers.add_parser("write_behind_metrics")
+    write_behind_metrics_parser.set_defaults(func=write_behind_metrics)
+
+    reap_temporary_parser = subparsers.add_parser("reap_temporary")
+    reap_temporary_parser.set_defaults(func=reap_temporary)
+
     args = parser.parse_args()
     if not hasattr(args, "func"):
         parser.error("no command selected")
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import requests
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+
+HTTP_PORT = os.environ.get("HTTP_PORT", None)
+
+if HTTP_PORT is not None:
+    BASE_URL = f"http://127.0.0.1:{HTTP_PORT}"
+else:
+    BASE_URL = f"http://127.0.0.1"
+
+
+def login(args) -> str:
+    response = requests.post(
+        f"{BASE_URL}/api/login",
+        json={
+            "username": args.username,
+            "password": args.password,
+        }
+    )
+    response.raise_for_status()
+    return response.json()["token"]
+
+
+def api(token: str, endpoint: str, **kwargs) -> requests.Response:
+    response = requests.post(f"{BASE_URL}/api{endpoint}", json={"token": token, **kwargs})
+    response.raise_for_status()
+    return response
+
+
+def measure(args, token: str, endpoint: str, **kwargs):
+    """
+    Returns the response size in bytes and the median latency in milliseconds.
+    """
+    timings = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        response = api(token, endpoint, **kwargs)
+        timings.append((time.perf_counter() - start) * 1000)
+    return len(response.content), statistics.median(timings)
+
+
+def folder_list(args):
+    token = login(args)
+    folder_id = api(token, "/folder/character/create", name="Benchmark").json()["id"]
+    try:
+        for i in range(args.count):
+            api(token, "/character/create", document={
+                "name": f"Benchmark {i}",
+                "folder_id": folder_id,
+                "description": "Lorem ipsum dolor sit amet. " * 80,
+                "stat_map": {
+                    f"stat{j}": {"id": f"stat{j}", "name": f"Stat {j}", "value": j}
+                    for j in range(20)
+                },
+                "stat_order": [f"stat{j}" for j in range(20)],
+                "item_map": {
+                    f"item{j}": {"name": f"Item {j}", "description": "A thing. " * 40}
+                    for j in range(30)
+                },
+                "item_order": [f"item{j}" for j in range(30)],
+            })
+
+        for full in (True, False):
+            size, latency = measure(args, token, "/folder/character/list", folder_id=folder_id, full=full)
+            print(f"folder_list full={full}: {size} bytes, {latency:.1f} ms median over {args.runs} runs")
+    finally:
+        api(token, "/folder/character/delete", folder_id=folder_id)
+
+
+def spawn(args):
+    """
+    Compares placing temporary copies of a character one at a time, the way
+    dropping them on a map does, with spawning them all at once.
+    """
+    token = login(args)
+    map_id = api(token, "/map/create").json()["id"]
+    template = api(token, "/character/create", document={"name": "Benchmark Goblin", "size": 1}).json()["id"]
+    character_ids = []
+    try:
+        start = time.perf_counter()
+        for i in range(args.count):
+            character_id = api(token, "/character/create", document={
+                "name": f"Benchmark Goblin - {i}", "size": 1, "temporary": True,
+            }).json()["id"]
+            character_ids.append(character_id)
+            api(token, "/map/update", id=map_id, changes={"$set": {
+                f"tokens.{os.urandom(12).hex()}": {
+                    "x": i * 150.0, "y": 0.0, "width": 150.0, "height": 150.0, "scale_type": 0,
+                    "character_id": character_id,
+                },
+            }})
+        one_at_a_time = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        response = api(token, "/map/spawn", id=map_id, character_id=template, count=args.count, x=0.0, y=1000.0)
+        at_once = (time.perf_counter() - start) * 1000
+        character_ids.extend(placed["character_id"] for placed in response.json()["tokens"].values())
+
+        print(f"spawn {args.count} tokens one at a time: {one_at_a_time:.1f} ms")
+        print(f"spawn {args.count} tokens at once: {at_once:.1f} ms")
+    finally:
+        for character_id in [template, *character_ids]:
+            api(token, "/character/delete", id=character_id)
+        api(token, "/map/delete", id=map_id)
+
+
+def permissions(args):
+    # Runs in process against the backend models rather than a server
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    from backend.lib.enums import Permissions
+    from backend.models.database_models import EntrySummary
+
+    class ReferenceSummary(EntrySummary):
+        def get_permission(self, id: str = "*", field: str = "*") -> Permissions:
+            # The lookup as it was before being compiled, walking the nested
+            # dictionaries on every call
+            entity_permissions = self.permissions.get(id, None)
+            if entity_permissions is None:
+                entity_permissions = self.permissions.get("*", {"*": Permissions.INHERIT})
+            field_permission = entity_permissions.get(field, None)
+            if field_permission is None:
+                field_permission = entity_permissions.get("*", Permissions.INHERIT)
+            if id != "*" and field_permission == Permissions.INHERIT:
+                return self.get_permission("*", field)
+            return field_permission
+
+        def has_permission(self, id: str = "*", field: str = "*", level: Permissions = Permissions.READ) -> bool:
+            return self.get_permission(id, field) >= level
+
+    rng = random.Random(args.seed)
+    ids = ["*", "user1", "user2", "user3"]
+    fields = ["*", "name", "image", "description"]
+
+    def random_permissions() -> dict:
+        return {
+            id: {field: rng.choice(list(Permissions)) for field in fields if rng.random() < 0.5}
+            for id in ids if rng.random() < 0.7
+        }
+
+    entries = [EntrySummary(permissions=random_permissions()) for _ in range(args.count)]
+    references = [ReferenceSummary(permissions=entry.permissions) for entry in entries]
+    cached = [EntrySummary(permissions=entry.permissions) for entry in entries]
+    for entry in cached:
+        entry.memoize_permissions()
+    requests = [(id, field) for id in ids + ["user4"] for field in fields + ["stat_map"]]
+
+    # Differential check of the memoized lookup against the original semantics
+    mismatches = 0
+    for entry, reference in zip(cached, references):
+        for id, field in requests:
+            if entry.get_permission(id, field) != reference.get_permission(id, field):
+                mismatches += 1
+    print(f"permissions: {mismatches} mismatches over {len(entries) * len(requests)} lookups")
+
+    # Freshly loaded documents look fields up directly, while documents held
+    # in the listing cache resolve each requester once then reuse it
+    for label, documents, fresh in (
+        ("reference", references, False),
+        ("loaded", entries, False),
+        ("cached first lookup", cached, True),
+        ("cached memoized", cached, False),
+    ):
+        timings = []
+        for _ in range(args.runs):
+            if fresh:
+                for entry in documents:
+                    entry._resolved_permissions = {}
+            start = time.perf_counter()
+            for entry in documents:
+                entry.has_permission("user1", "*", Permissions.READ)
+            timings.append((time.perf_counter() - start) * 1000)
+        print(f"permissions {label}: {statistics.median(timings):.2f} ms median for {args.count} entries over {args.runs} runs")
+
+
+def random_strokes(rng: random.Random, count: int) -> list:
+    """
+    A brush wandering through a dungeon, revealing rectangles of corridor
+    and rooms with the occasional hide.
+    """
+    import shapely
+    strokes = []
+    x, y = 0.0, 0.0
+    for _ in range(count):
+        x += rng.uniform(-150, 200)
+        y += rng.uniform(-150, 200)
+        width, height = rng.uniform(50, 400), rng.uniform(50, 400)
+        strokes.append((rng.random() >= 0.1, shapely.box(x, y, x + width, y + height)))
+    return strokes
+
+
+def fog(args):
+    # Runs in process against the backend fog of war code rather than a server
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    import shapely
+    from backend.lib import geometry
+
+    strokes = random_strokes(random.Random(args.seed), args.strokes)
+
+    def replay(snap: bool) -> tuple[list[float], shapely.geometry.base.BaseGeometry]:
+        revealed = shapely.Polygon()
+        written = revealed
+        timings = []
+        for index, (reveal, area) in enumerate(strokes):
+            start = time.perf_counter()
+            if snap:
+                revealed = geometry.reveal(revealed, area) if reveal else geometry.hide(revealed, area)
+                # Stand in for the write-behind simplifying and snapping a
+                # copy every few edits
+                if index % args.flush_every == args.flush_every - 1:
+                    written = shapely.set_precision(geometry.simplify(revealed), geometry.FOG_GRID_SIZE)
+            else:
+                revealed = revealed.union(area) if reveal else revealed.difference(area)
+                written = revealed
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings, written
+
+    for label, snap in (("full precision", False), ("snapped and simplified", True)):
+        timings, revealed = replay(snap)
+        geojson_bytes = len(json.dumps(shapely.geometry.mapping(revealed)))
+        wkb_bytes = len(shapely.to_wkb(revealed))
+        print(
+            f"fog {label}: {sum(timings):.0f} ms total, {statistics.median(timings):.2f} ms median, "
+            f"{max(timings):.2f} ms max per stroke over {args.strokes} strokes; "
+            f"{shapely.get_num_coordinates(revealed)} vertices, {geojson_bytes} GeoJSON bytes, {wkb_bytes} WKB bytes"
+        )
+
+
+def fog_stall(args):
+    # Runs in process against the backend fog of war code rather than a server
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    import asyncio
+    import shapely
+    from backend.lib import geometry
+
+    # Start from a map that has already seen a long session of edits
+    rng = random.Random(args.seed)
+    initial = shapely.Polygon()
+    for reveal, area in random_strokes(rng, args.strokes):
+        initial = geometry.reveal(initial, area) if reveal else geometry.hide(initial, area)
+    initial = geometry.simplify(initial)
+    minx, miny, maxx, maxy = initial.bounds
+    edits = []
+    for _ in range(args.edits):
+        x, y = rng.uniform(minx, maxx), rng.uniform(miny, maxy)
+        # Large brushes, as when revealing a whole room at once
+        edits.append((rng.random() >= 0.5, [(x, y), (x + 600, y), (x + 600, y + 600), (x, y + 600)]))
+
+    def apply_edit(revealed, coordinates, reveal):
+        area = geometry.to_polygon(coordinates)
+        revealed = geometry.reveal(revealed, area) if reveal else geometry.hide(revealed, area)
+        return revealed, geometry.get_chunks(revealed, geometry.chunk_keys(area.bounds))
+
+    async def run(offload: bool) -> tuple[list[float], float]:
+        revealed = initial
+        lock = asyncio.Lock()
+        lags = []
+        done = asyncio.Event()
+
+        async def monitor():
+            # How late the loop gets around to a timer, which is how long
+            # every other connection would have waited too
+            interval = args.interval / 1000
+            while not done.is_set():
+                start = time.perf_counter()
+                await asyncio.sleep(interval)
+                lags.append((time.perf_counter() - start - interval) * 1000)
+
+        async def editor(batch):
+            nonlocal revealed
+            for reveal, coordinates in batch:
+                if offload:
+                    async with lock:
+                        revealed, _ = await geometry.run_geometry(apply_edit, revealed, coordinates, reveal)
+                else:
+                    revealed, _ = apply_edit(revealed, coordinates, reveal)
+                    await asyncio.sleep(0)
+
+        monitor_task = asyncio.create_task(monitor())
+        start = time.perf_counter()
+        # Several people editing the same map at once
+        await asyncio.gather(*(editor(edits[i::args.editors]) for i in range(args.editors)))
+        elapsed = (time.perf_counter() - start) * 1000
+        done.set()
+        await monitor_task
+        return lags, elapsed
+
+    for label, offload in (("on the loop", False), ("in the geometry pool", True)):
+        lags, elapsed = asyncio.run(run(offload))
+        lags.sort()
+        print(
+            f"fog_stall {label}: {elapsed:.0f} ms for {args.edits} edits from {args.editors} editors; "
+            f"loop lag {statistics.median(lags):.2f} ms median, {lags[int(len(lags) * 0.99)]:.2f} ms p99, "
+            f"{lags[-1]:.2f} ms max"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks against a running server, or in process for the backend "
+        "models. Use a dedicated GM account, benchmarks create and delete their own documents."
+    )
+    parser.add_argument("--runs", type=int, default=20)
+    subparsers = parser.add_subparsers()
+
+    # Benchmarks against a running server log in first
+    server_parser = argparse.ArgumentParser(add_help=False)
+    server_parser.add_argument("username")
+    server_parser.add_argument("password")
+
+    folder_list_parser = subparsers.add_parser("folder_list", parents=[server_parser])
+    folder_list_parser.add_argument("--count", type=int, default=500)
+    folder_list_parser.set_defaults(func=folder_list)
+
+    spawn_parser = subparsers.add_parser("spawn", parents=[server_parser])
+    spawn_parser.add_argument("--count", type=int, default=100)
+    spawn_parser.set_defaults(func=spawn)
+
+    permissions_parser = subparsers.add_parser("permissions")
+    permissions_parser.add_argument("--count", type=int, default=10000)
+    permissions_parser.add_argument("--seed", type=int, default=0)
+    permissions_parser.set_defaults(func=permissions)
+
+    fog_parser = subparsers.add_parser("fog")
+    fog_parser.add_argument("--strokes", type=int, default=500)
+    fog_parser.add_argument("--flush-every", type=int, default=10)
+    fog_parser.add_argument("--seed", type=int, default=0)
+    fog_parser.set_defaults(func=fog)
+
+    fog_stall_parser = subparsers.add_parser("fog_stall")
+    fog_stall_parser.add_argument("--strokes", type=int, default=2000)
+    fog_stall_parser.add_argument("--edits", type=int, default=100)
+    fog_stall_parser.add_argument("--editors", type=int, default=4)
+    fog_stall_parser.add_argument("--interval", type=float, default=1.0, help="milliseconds between loop lag samples")
+    fog_stall_parser.add_argument("--seed", type=int, default=0)
+    fog_stall_parser.set_defaults(func=fog_stall)
+
+    args = parser.parse_args()
+    if not hasattr(args, "func"):
+        parser.error("no command selected")
+    args.func(args)